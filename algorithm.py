@@ -1,154 +1,289 @@
 import numpy as np
 import pandas as pd
-from matplotlib import pyplot as plt
-import seaborn as sns; sns.set()
 pd.options.mode.chained_assignment = None
-from scipy.spatial.distance import mahalanobis
-from pathlib import Path
+import params
+import profiling
+import report
 
-def iqr_method(f_df, col):
+# which rule decides whether a sample is "far", see inverse_covariances
+MAHALANOBIS = 0
+IQR_Y = 1 # unit_price has no spread, 1D IQR on the weight column
+IQR_X = 2 # weight has no spread, 1D IQR on unit_price
+
+def explanatory_vars(country):
+    """
+    Helper function. Columns used as the x and y axes for a country's samples
+    """
+    # todo: update this to include records that use count instead of weight
+    if country == 'HND':
+        return ['unit_price', 'weight_lbs']
+    else:
+        return ['unit_price', 'weight_kg']
+
+def fence_factor(country, has_limits):
+    """
+    Helper function. Multiple of the 90th percentile Mahalanobis distance past
+    which a sample is considered far (see detection.ini)
+    """
+    if has_limits:
+        return params.current['fence_factor']['limits'][country]
+    else:
+        return params.current['fence_factor']['no_limits'][country]
+
+def iqr_method(f_df, col, sketch=None):
     """
-    Helper function. Flag potential outliers using conventional 1D IQR rule
+    Helper function. Flag potential outliers using conventional 1D IQR rule.
+    If a quantile sketch of the column is given (see sketch.py), the quartiles
+    are read from it instead of being computed from all the samples, unless
+    it still holds all of them.
     """
     x = f_df[col]
-    q1 = np.quantile(x, 0.25)
-    q3 = np.quantile(x, 0.75)
+    if sketch is None or sketch.exact():
+        q1 = np.quantile(x, 0.25)
+        q3 = np.quantile(x, 0.75)
+    else:
+        q1, q3 = sketch.quantile([0.25, 0.75])
     iqr = q3 - q1
     far = f_df[(x > q3 + 1.5*iqr) | (x < q1 - 1.5*iqr)]
     return far
     
-def mahalanobis_method(f_df, expl_vars, mu, country, has_limits):
+def covariances(points, group=None, k=1):
+    """
+    Helper function. Covariance matrices of many groups of 2D points at once.
+    Like DataFrame.cov, samples with a nan coordinate are left out pairwise:
+    each variance uses the samples that have that coordinate, the covariance
+    those that have both.
+
+    Parameters
+    ----------
+    points (ndarray)
+        (n, 2) log-scale samples
+    group (ndarray[int] or None)
+        (n,) which of the k groups each sample belongs to (all in one if None)
+    k (int)
+        number of groups
+
+    Returns:
+    cov (ndarray)
+        (k, 2, 2) sample covariance of each group (nan where fewer than 2
+        samples have the coordinates)
+    """
+    if group is None:
+        group = np.zeros(points.shape[0], dtype=int)
+    known = ~np.isnan(points)
+    cov = np.empty((k, 2, 2))
+    for i, j in [(0, 0), (1, 1), (0, 1)]:
+        both = known[:, i] & known[:, j]
+        g = group[both]
+        x = points[both, i]
+        y = points[both, j]
+        n = np.bincount(g, minlength=k).astype(float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_x = np.bincount(g, x, k)/n
+            mean_y = np.bincount(g, y, k)/n
+            c = np.bincount(g, (x - mean_x[g])*(y - mean_y[g]), k)/(n - 1)
+        c[n < 2] = np.nan
+        cov[:, i, j] = c
+    cov[:, 1, 0] = cov[:, 0, 1]
+    return cov
+
+def inverse_covariances(cov):
+    """
+    Helper function. Invert many 2x2 covariance matrices at once and pick the
+    rule each fish is judged by:
+
+    - IQR_Y if the unit_price variance is below min_variance (the samples lie
+      on a vertical line) or can't be computed (fewer than 2 prices)
+    - IQR_X if the same goes for the weight variance
+    - MAHALANOBIS otherwise. The price-weight correlation is capped at
+      max_correlation (see detection.ini), which keeps the inverse stable for
+      fish whose samples are nearly on a line, e.g. fixed-price species.
+
+    Samples missing a price or weight don't count towards its variance (see
+    covariances), so one missing weight doesn't switch a fish to IQR_X.
+
+    Returns:
+    vi (ndarray)
+        (k, 2, 2) inverse covariances (zeros for the IQR rules)
+    method (ndarray[int])
+        (k,) one of MAHALANOBIS, IQR_Y, IQR_X
+    """
+    var_x = cov[:, 0, 0]
+    var_y = cov[:, 1, 1]
+    min_variance = params.current['min_variance']
+    method = np.full(cov.shape[0], MAHALANOBIS)
+    method[~(var_y >= min_variance)] = IQR_X
+    method[~(var_x >= min_variance)] = IQR_Y
+
+    vi = np.zeros_like(cov)
+    m = method == MAHALANOBIS
+    sx = np.sqrt(var_x[m])
+    sy = np.sqrt(var_y[m])
+    max_r = params.current['max_correlation']
+    r = np.clip(cov[m, 0, 1]/(sx*sy), -max_r, max_r)
+    # inverse of [[sx^2, r sx sy], [r sx sy, sy^2]]
+    vi[m, 0, 0] = 1/(var_x[m]*(1 - r**2))
+    vi[m, 1, 1] = 1/(var_y[m]*(1 - r**2))
+    vi[m, 0, 1] = vi[m, 1, 0] = -r/(sx*sy*(1 - r**2))
+    return vi, method
+
+def mahalanobis_distances(obs, expl_vars, mu, vi):
+    """
+    Helper function. Mahalanobis distance of every sample in obs from mu.
+    """
+    diff = obs[expl_vars].values - np.asarray(mu)
+    return np.sqrt(np.maximum(np.einsum('ni,ij,nj->n', diff, vi, diff), 0))
+
+def mahalanobis_method(f_df, expl_vars, mu, vi, country, has_limits):
     """
     Helper function. Flag potential outliers if they exceed the 90th percentile
     Mahalanobis distance by a certain threshold (which varies by country)
     """
-    cov = f_df[expl_vars].cov()
-    vi = np.linalg.inv(cov)
-    m_dist = []
-    
-    for ii, row in f_df[expl_vars].iterrows():
-        d = mahalanobis(mu, row, vi)
-        m_dist.append(d)
-    
+    m_dist = mahalanobis_distances(f_df, expl_vars, mu, vi)
     q90 = np.quantile(m_dist, 0.9)
-    if has_limits:
-        fence_factor = {
-            'HND': 2,
-            'IDN': 1.5,
-            'MOZ': 2, # currently unused
-            'PHL': 2
-        }
-    else:
-        fence_factor = {
-            'HND': 1.5,
-            'IDN': 2,
-            'MOZ': 2,
-            'PHL': 2.5
-        }
-    fence = fence_factor[country]*q90
+    fence = fence_factor(country, has_limits)*q90
     far = f_df[m_dist > fence]
     return far
 
+def months(dates):
+    """
+    Helper function. Month of every date (text such as '2021-03-12 10:15:30+00',
+    or datetime64) as a number, year*12 + month - 1.
+    """
+    values = dates.to_numpy()
+    if values.dtype.kind == 'M':
+        return values.astype('datetime64[M]').astype(np.int64) + 1970*12
+    # read the digits of yyyy-mm straight from the bytes of the text
+    digits = values.astype('S7').view(np.uint8).reshape(-1, 7).astype(np.int64)\
+                - ord('0')
+    year = digits[:, 0]*1000 + digits[:, 1]*100 + digits[:, 2]*10 + digits[:, 3]
+    return year*12 + digits[:, 5]*10 + digits[:, 6] - 1
+
+def sample_history(all_df, names, today_ids):
+    """
+    Helper function. Cap the number of past samples each fish is fit on, see
+    [sampling] in detection.ini. Today's samples are always kept. With
+    mode = uniform, past samples are picked uniformly at random; with
+    mode = month, every month of a fish's history keeps the same fraction of
+    its samples, so busy seasons don't crowd out quiet ones. All the fish are
+    sampled in one go, before anything is fit on their samples.
+
+    Parameters
+    ----------
+    all_df (DataFrame)
+        samples of the fish in names
+    names (array[str])
+        buying_unit of each fish
+    today_ids (array)
+        ids of today's samples
+
+    Returns:
+    fit_df (DataFrame)
+        all_df itself if sampling is off or no history is long enough,
+        otherwise the sampled histories plus today's samples
+    """
+    sampling = params.current['sampling']
+    if sampling['mode'] == 'off':
+        return all_df
+    cap = sampling['max_samples']
+    fish = pd.Index(names).get_indexer(all_df['buying_unit'])
+    past = ~all_df['id'].isin(today_ids).values
+    n_past = np.bincount(fish[past], minlength=len(names))
+    if (n_past <= cap).all():
+        return all_df
+
+    # past samples of the fish over the cap, split into groups (the fish, or
+    # one month of the fish) that each keep `quota` samples
+    rows = np.flatnonzero(past & (n_past[fish] > cap))
+    group = fish[rows]
+    if sampling['mode'] == 'month':
+        month = months(all_df['date'].iloc[rows])
+        month = month - month.min()
+        n_months = month.max() + 1
+        group = group*n_months + month
+        size = np.bincount(group, minlength=len(names)*n_months)
+        frac = cap/np.maximum(n_past[np.arange(size.size)//n_months], 1)
+        quota = np.round(frac*size)
+    else:
+        quota = np.full(len(names), cap)
+
+    # shuffle the samples within each group (sorting by group + a random
+    # fraction) and keep the first `quota`
+    rng = np.random.default_rng(sampling['seed'])
+    order = np.argsort(group + rng.random(rows.size))
+    group = group[order]
+    rank = np.arange(rows.size) - np.searchsorted(group, group)
+    keep = np.ones(all_df.shape[0], dtype=bool)
+    keep[rows] = False
+    keep[rows[order[rank < quota[group]]]] = True
+    return all_df[keep]
+
 def far_enough(obs, expl_vars, mu):
     """
     Remove points from oob/far that are too close to the mean. Too close means
     Less than 0.5 units in the x-directions and less than 1 unit in the
-    y-direction, both in log-scale
+    y-direction, both in log-scale (by default, see detection.ini)
     """
     x = expl_vars[0]
     y = expl_vars[1]
-    return obs[(np.abs(obs[x] - mu[0]) > 0.5) | \
-                (np.abs(obs[y] - mu[1]) > 1)]
+    margins = params.current['far_enough_margins']
+    return obs[(np.abs(obs[x] - mu.iloc[0]) > margins[0]) | \
+                (np.abs(obs[y] - mu.iloc[1]) > margins[1])]
                 
-def plot_data(f, f_df, ycol, mu, far, oob, limits):
+def resolve_limits(fish, names, mu):
     """
-    Plot samples and mark points that are flagged by distance and exceeding limits.
-    
+    Helper function. Thresholds of many fish at once, in log-scale. Thresholds
+    that a fish doesn't have on record (or all of them, if the fish isn't in
+    the fish db) are placed a certain distance away from its centroid, see
+    detection.ini.
+
     Parameters
     ----------
-    f (DataFrame)
-        fish information from clean_fish.py. Used for veryfying weight_units
-    f_df (DataFrame)
-        samples for the current fish, taken from df from data_clean.py
-    ycol (str)
-        either weight_kg or weight_lbs (todo:count)
-    mu (Series)
-        centroid of samples
-    far (DataFrame)
-        samples that exceed Mahalanobis fence
-    oob (DataFrame)
-        samples that exceed pre-programmed thresholds, if any
-    limits (dict[float])
-        thresholds from f
-        
-    
+    fish (DataFrame)
+        Cleaned version of fish dataset
+    names (array[str])
+        buying_unit of each fish
+    mu (ndarray)
+        (len(names), 2) centroid of each fish's samples
+
     Returns:
-    ax (AxesSubplot)
-        Plot object for saving later.
+    limits (ndarray)
+        (len(names), 3) weight max, price min and price max of each fish
+    has_limits (ndarray[bool])
+        which fish have thresholds on record
+    is_lbs (ndarray[bool])
+        which fish have their weight threshold in lbs
     """
-    ax = sns.scatterplot(data=f_df, x='unit_price', y=ycol)
-
-    # plot the mean point
-    ax.scatter(x=mu[0], y=mu[1],
-           color='r', marker='*', s=200)
-
-    # mark m_dist far points with a magenta +
-    ax.scatter(x=far['unit_price'],
-           y=far[ycol],
-           s=100, color='magenta', marker='+')
-           
-    # plot stuff relating to the thresholds
-
-    # mark points exceeding thresholds with a green x
-    ax.scatter(x=oob['unit_price'],
-               y=oob[ycol],
-               s=100, color='green', marker='x')
-
-    # highlight the regions exceeding thresholds
-    x_min = ax.get_xlim()[0]
-    x_max = ax.get_xlim()[1]
-    y_min = ax.get_ylim()[0]
-    y_max = ax.get_ylim()[1]
-
-    # exceeding price min
-    if x_min < limits['price_min']:
-        ax.axvspan(xmin=x_min, xmax=limits['price_min'],
-                   facecolor='r', alpha=0.1)
-    else:
-        ax.plot(limits['price_min']*np.ones(2), [y_min, y_max], 'r')
+    offsets = params.current['default_limit_offsets']
+    fish_cols = {'weight': 'weight_max', 'price_min': 'price_min',
+                 'price_max': 'price_max'}
+    on_record = fish.drop_duplicates(subset='name').set_index('name')\
+                    .reindex(names)[[fish_cols[k] for k in offsets]]
+    limits = np.log10(on_record.values.astype(float) + params.current['log_offset'])
+    defaults = np.column_stack([mu[:, axis] + offset for axis, offset
+                                in offsets.values()])
+    limits = np.where(np.isnan(limits), defaults, limits)
 
-    # exceeding price max
-    if limits['price_max'] < x_max:
-        ax.axvspan(xmin=limits['price_max'], xmax=x_max,
-                   facecolor='r', alpha=0.1)
-    else:
-        ax.plot(limits['price_max']*np.ones(2), [y_min, y_max], 'r')
-    
-    # exceeding weight max
-    if limits['weight'] < y_max:
-        ax.axhspan(ymin=limits['weight'], ymax=y_max,
-                  facecolor='b', alpha=0.1)
-    else:
-        ax.plot([x_min, x_max], limits['weight']*np.ones(2), 'b')
+    has_limits = np.isin(names, fish['name'].values)
+    is_lbs = np.isin(names, fish.loc[fish['weight_units'] == 'lbs', 'name'].values)
+    return limits, has_limits, is_lbs
 
-    plt.close()
-    
-    return ax
-    
-def main(df, archive_df, fish, country, date):
+def main(df, archive_df, fish, country, date, sketches=None,
+         profiler=profiling.NULL):
     """
     Flag potential outliers in the dataset obtained from psql server.
     The algorithm works as follows:
     
     1. Find the subset of unique buying_unit from df that exist in fish.
-    2. Filter out the fish that have less than 10 samples.
+    2. Filter out the fish that have less than 10 samples (min_samples).
     3. Iterate through these fish and do as follows:
         a. if the distribution of the explanatory variables looks like a straight
-            line, do a simple 1D IQR method to find "far" points (far)
+            horizontal or vertical line, do a simple 1D IQR method to find
+            "far" points (far)
         b. otherwise, use mahalanobis distance to find "far" points (far)
         c. find points (oob) that exceed thresholds from the fish db
         d. flag points (flagged) that belong to both sets described in a/b and c
-        e. create and save plots for any fish species w/ flagged points
+        e. collect plot data for any fish species w/ flagged points
     
     One issue with this algorithm is how to iterate through the data. Currently,
     we iterate through the fish name, buying_unit. About 1400 samples (as of
@@ -171,111 +306,112 @@ def main(df, archive_df, fish, country, date):
         Cleaned version of fish dataset
     country (str)
         Country code e.g. 'HND'
+    date (str)
+        e.g. '2021-03-12'
+    sketches (dict or None)
+        {(buying_unit, col): KLL} quantile sketches of the log-scale samples
+        in archive_df and df (see sketch.by_species), used for the IQR method
+    profiler (profiling.Profiler)
+        records per-fish timings, see profiling.py; off by default
     
     Returns:
     flagged (`pd.DataFrame`)
         Subset of df containing potential outliers.
+    panels (list[dict])
+        plot data for the flagged species, for report.write
     """
     c_df = df.query("country == @country")
     fish_list = c_df['buying_unit'].unique()
     important_fish = archive_df.query("buying_unit.isin(@fish_list)")\
                         .groupby(by='buying_unit', dropna=True).size()
-    important_fish = important_fish[important_fish >= 10].index.values
+    min_samples = params.current['min_samples']
+    important_fish = important_fish[important_fish >= min_samples].index.values
 
-    # todo: update this to include records that use count instead of weight
-    if country == 'HND':
-        expl_vars = ['unit_price', 'weight_lbs']
-    else:
-        expl_vars = ['unit_price', 'weight_kg']
+    expl_vars = explanatory_vars(country)
     ycol = expl_vars[1]
     
     # the following are running tallies for results
     samples = 0
     
-    images = [] # this will be passed to emailing.py
-    flagged = pd.DataFrame()
+    panels = [] # this will be passed to report.py
+    flagged = [] # flagged records of each fish, concatenated at the end
     
-    df_all = archive_df.append(df)
-    for fname in important_fish:
-        if fname in fish['name'].unique(): # fish has thresholds on record
-            has_limits = True
-        else:
-            has_limits = False
-            
-        f = fish.query("name == @fname")
-        f_df = df_all.query("buying_unit == @fname")
-        # add 1e-1 to avoid log(0)
-        f_df[expl_vars] = f_df[expl_vars].apply(lambda x: np.log10(x+1e-1))
+    df_all = pd.concat([archive_df, df])
+    if sketches is None:
+        sketches = {}
+
+    # log-scale samples of all the important fish at once
+    # add log_offset (0.1 by default) to avoid log(0)
+    all_df = df_all[df_all['buying_unit'].isin(important_fish)]
+    all_df = sample_history(all_df, important_fish, df['id'])
+    all_df[expl_vars] = np.log10(all_df[expl_vars] + params.current['log_offset'])
+    groups = all_df.groupby(by='buying_unit')
+    mu_all = groups[expl_vars].mean().reindex(important_fish) # for m_dist and plotting
+    limits_all, has_limits_all, lbs_all = resolve_limits(fish, important_fish,
+                                                         mu_all.values)
+
+    # covariance and inverse of every fish at once, and whether it is judged
+    # by the IQR rule or the Mahalanobis distance
+    group = pd.Index(important_fish).get_indexer(all_df['buying_unit'])
+    cov_all = covariances(all_df[expl_vars].values, group, important_fish.size)
+    vi_all, method_all = inverse_covariances(cov_all)
+
+    # find today's samples that exceed at least one threshold of their fish and
+    # aren't too close to its centroid, for all the fish in one go
+    today = all_df[all_df['id'].isin(df['id'])]
+    idx = pd.Index(important_fish).get_indexer(today['buying_unit'])
+    lim = limits_all[idx]
+    mu_today = mu_all.values[idx]
+    price = today['unit_price'].values
+    weight = np.where(lbs_all[idx], today['weight_lbs'].values,
+                      today['weight_kg'].values)
+    exceeds = (weight > lim[:, 0]) | (price < lim[:, 1]) | (price > lim[:, 2])
+    margins = params.current['far_enough_margins']
+    enough = (np.abs(price - mu_today[:, 0]) > margins[0]) | \
+                (np.abs(today[ycol].values - mu_today[:, 1]) > margins[1])
+    oob_all = today[exceeds & enough]
+
+    for ii, fname in enumerate(important_fish):
+        has_limits = has_limits_all[ii]
+        f_df = groups.get_group(fname)
         samples += f_df.shape[0]
- 
-        mu = f_df[expl_vars].mean() # used for m_dist and plotting
-        if f_df['unit_price'].var() == 0: # observations are 1D in unit_price-weight
-            far = iqr_method(f_df, ycol)
+        profiler.species(country, fname, f_df.shape[0])
 
-        elif f_df[ycol].var() == 0: # same but horizontally
-            far = iqr_method(f_df, 'unit_price')
-    
-        else: # do mahalanobis distance method
-            far = mahalanobis_method(f_df, expl_vars, mu, country, has_limits)
-        far = far[far['id'].isin(df['id'])] # only take today's samples
-        
-        # assign fences for pre-programmed thresholds
-        limits = {
-            'weight': np.nan,
-            'price_min': np.nan,
-            'price_max': np.nan
-        }
-        
-        if has_limits: # if fish has thresholds on record
-            # get the threshold values from fish
-            # indexing at 0 to avoid VisibleDeprecationWarning
-            limits['weight'] = np.log10(f['weight_max'].values[0]+1e-1) 
-            limits['price_min'] = np.log10(f['price_min'].values[0]+1e-1)
-            limits['price_max'] = np.log10(f['price_max'].values[0]+1e-1)
-        
-        # in case there are any threshold records missing/the fish had
-        # non on record, define the thresholds a certain distance away
-        # from the centroid
-        for k in limits.keys():
-            if np.isnan(limits[k]): # did not have existing limit
-                if k == 'weight':
-                    limits[k] = mu[1] + 2
-                elif k == 'price_min':
-                    limits[k] = mu[0] - 1.5
-                elif k == 'price_max':
-                    limits[k] = mu[0] + 1.5
-
-        # find samples that exceed at least one threshold
-        if (f['weight_units'] == 'lbs').any():
-            oob = f_df.query("(weight_lbs > @limits['weight']) | \
-                                (unit_price < @limits['price_min']) | \
-                                (unit_price > @limits['price_max'])")
-            oob = oob[oob['id'].isin(df['id'])] # only take today's samples
-        else:
-            oob = f_df.query("(weight_kg > @limits['weight']) | \
-                                (unit_price < @limits['price_min']) | \
-                                (unit_price > @limits['price_max'])")
-            oob = oob[oob['id'].isin(df['id'])]
-    
-        # potential outliers for this fish are both oob and far
-        oob = far_enough(oob, expl_vars, mu)
-        far = far_enough(far, expl_vars, mu)
-        flag_ids = pd.merge(oob, far, on='id', how='inner')['id'].unique()
-        
-        
-        # record flagged samples, create scatter plot and save
+        mu = mu_all.iloc[ii]
+        with profiler.section('distance'):
+            method = method_all[ii]
+            vi = vi_all[ii]
+            if method == IQR_Y: # observations are 1D in unit_price-weight
+                profiler.branch('IQR-y')
+                far = iqr_method(f_df, ycol, sketches.get((fname, ycol)))
+
+            elif method == IQR_X: # same but horizontally
+                profiler.branch('IQR-x')
+                far = iqr_method(f_df, 'unit_price',
+                                 sketches.get((fname, 'unit_price')))
+
+            else: # do mahalanobis distance method
+                profiler.branch('Mahalanobis')
+                far = mahalanobis_method(f_df, expl_vars, mu, vi, country,
+                                         has_limits)
+            far = far[far['id'].isin(df['id'])] # only take today's samples
+
+        with profiler.section('thresholding'):
+            # potential outliers for this fish are both oob and far
+            oob = oob_all[oob_all['buying_unit'] == fname]
+            far = far_enough(far, expl_vars, mu)
+            flag_ids = pd.merge(oob, far, on='id', how='inner')['id'].unique()
+            limits = dict(zip(params.current['default_limit_offsets'], limits_all[ii]))
+        profiler.flagged(flag_ids.size)
+
+        # record flagged samples and the data for their plot in the report
         if flag_ids.size > 0: # only if any samples were flagged
-            flagged = flagged.append(df.query("id.isin(@flag_ids)"))
-            ax = plot_data(f, f_df, expl_vars[1], mu, far, oob, limits)
-                
-            ax.set_title("country="+country+", buying_unit="+str(fname)+\
-                        "\n %d potential outlier(s) (n=%d)"\
-                        % (flag_ids.size, f_df.shape[0]))
-            
-            date = date.replace('-','_')
-            plot_num = len(images)+1
-            img_path = Path('./plots/'+date+'/plot%.2d.png' % plot_num)
-            images.append(img_path)
-            img_path.parent.mkdir(exist_ok=True) # create dir for the date
-            ax.figure.savefig(img_path, dpi=150)
-    return flagged, images
\ No newline at end of file
+            flagged.append(df.query("id.isin(@flag_ids)"))
+            with profiler.section('plotting'):
+                panels.append(report.panel(country, fname, ycol, f_df, mu, far, oob,
+                                           limits, flag_ids.size))
+    if len(flagged) > 0:
+        flagged = pd.concat(flagged)
+    else:
+        flagged = pd.DataFrame()
+    return flagged, panels
\ No newline at end of file
@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import data_clean
+import postgres
+import sketch
+
+ARCHIVE_PATH = Path('./data/pg_data_clean.csv')
+ARCHIVE_DF_PATH = Path('./data/clean_catch_data.csv')
+FISH_PATH = Path('./data/fishdata_buyingunit_clean.csv')
+# sorted ids of the records in each archive csv, so appends can skip records
+# that are already archived without scanning the csv
+INDEX_PATHS = {
+    'archive': Path('./data/pg_data_clean_ids.npy'),
+    'archive_df': Path('./data/clean_catch_data_ids.npy')
+}
+CSV_PATHS = {
+    'archive': ARCHIVE_PATH,
+    'archive_df': ARCHIVE_DF_PATH
+}
+
+def load_index(key, frame):
+    """
+    Load the sorted id index of an archive csv. If it is missing or out of
+    date, rebuild it from the frame; if the frame has duplicate ids (from
+    reruns before the index existed), keep the last copy of each record and
+    rewrite the csv.
+
+    Returns:
+    frame (DataFrame)
+        the archive, without duplicate ids
+    ids (ndarray)
+        sorted unique ids of frame
+    """
+    try:
+        ids = np.load(INDEX_PATHS[key])
+        if ids.size == frame.shape[0]:
+            return frame, ids
+    except FileNotFoundError:
+        pass
+
+    ids = np.unique(frame['id'].values)
+    if ids.size != frame.shape[0]:
+        frame = frame.drop_duplicates(subset='id', keep='last')\
+                    .reset_index(drop=True)
+        frame.to_csv(CSV_PATHS[key], index=False)
+    np.save(INDEX_PATHS[key], ids)
+    return frame, ids
+
+def is_archived(ids, new_ids):
+    """
+    Helper function. Which of new_ids are in the sorted array ids, found by
+    binary search.
+    """
+    if ids.size == 0:
+        return np.zeros(len(new_ids), dtype=bool)
+    pos = np.searchsorted(ids, new_ids)
+    pos[pos == ids.size] = ids.size - 1 # past the end, won't match
+    return ids[pos] == new_ids
+
+def load(host, db, user, password, pool=None, eps=sketch.DEFAULT_EPS,
+         binary=False):
+    """
+    Load the archived (cleaned) catch data and the fish thresholds into memory.
+    If the archive doesn't exist yet (first run or file was deleted), pull
+    everything from the pg server, clean it and write it out (with a binary
+    COPY if `binary`, see postgres.query_data).
+
+    Returns:
+    state (dict)
+        'archive': full cleaned postgres data (from postgres.clean_postgres_data)
+        'archive_df': 'lite' version of archive (from data_clean.main)
+        'fish': cleaned fish data (from clean_fish.main)
+        'ids': {'archive': sorted ids, 'archive_df': sorted ids}
+        'sketches': {(country, buying_unit, col): KLL} quantile sketches of
+            archive_df with rank error eps (see sketch.py)
+    """
+    try: # round_trip, so floats read back equal to what append compares them with
+        archive = pd.read_csv(str(ARCHIVE_PATH), float_precision='round_trip')
+        archive_df = pd.read_csv(str(ARCHIVE_DF_PATH), float_precision='round_trip')
+    except FileNotFoundError:
+        pg_archive = postgres.query_data(host, db, user, password, pool=pool,
+                                         binary=binary)
+        archive = postgres.clean_postgres_data(pg_archive)
+        archive.to_csv(ARCHIVE_PATH, index=False)
+        archive_df = data_clean.main(archive)
+        archive_df.to_csv(ARCHIVE_DF_PATH, index=False)
+        for path in INDEX_PATHS.values(): # from an older archive
+            path.unlink(missing_ok=True)
+
+    archive, archive_ids = load_index('archive', archive)
+    archive_df, archive_df_ids = load_index('archive_df', archive_df)
+    sketches = sketch.load(archive_df, eps)
+
+    # load fish data; eventually set this up like catch data where
+    # the pg server is queried and the raw data is cleaned
+    fish = pd.read_csv(FISH_PATH)
+
+    state = {
+        'archive': archive,
+        'archive_df': archive_df,
+        'fish': fish,
+        'ids': {
+            'archive': archive_ids,
+            'archive_df': archive_df_ids
+        },
+        'sketches': sketches,
+        'eps': eps
+    }
+    return state
+
+def _changed(old, new):
+    """
+    Helper function. ids of the records in new (indexed by id) that differ
+    from their archived version in old (also indexed by id).
+    """
+    old = old.loc[new.index, new.columns]
+    same = (old.values == new.values) | (pd.isna(old.values) & pd.isna(new.values))
+    return new.index.values[~same.all(axis=1)]
+
+def append(state, data, df):
+    """
+    Add new records to the archive, both in memory and on disk. Records are
+    looked up in the id index, so appending the same day twice is a no-op.
+    Records that are already archived but have changed (corrected in the pg
+    server) replace their archived version.
+
+    Only new records are written; the csv files are appended to, and only
+    rewritten if some records were corrected. The frames in `state` are
+    replaced rather than modified, so anyone still holding the old archive_df
+    keeps seeing the data from before the update. The quantile sketches get
+    the new samples added, and are rebuilt for species with corrected records.
+
+    Parameters
+    ----------
+    state (dict)
+        from load
+    data (DataFrame)
+        new records, cleaned by postgres.clean_postgres_data
+    df (DataFrame)
+        'lite' version of data, from data_clean.main
+
+    Returns:
+    n_new (int)
+        number of records that weren't archived yet
+    n_corrected (int)
+        number of archived records that were replaced
+    """
+    archived = is_archived(state['ids']['archive'], data['id'].values)
+    corrected = np.array([], dtype=data['id'].dtype)
+    if archived.any(): # only compare these against the archive
+        old = state['archive']
+        old = old[old['id'].isin(data['id'].values[archived])].set_index('id')
+        corrected = _changed(old, data[archived].set_index('id'))
+
+    added = {}
+    for key, new in [('archive', data), ('archive_df', df)]:
+        frame = state[key]
+        ids = state['ids'][key]
+        path = CSV_PATHS[key]
+
+        # records that were corrected lose their old version
+        if corrected.size > 0:
+            frame = frame[~frame['id'].isin(corrected)]
+            ids = np.setdiff1d(ids, corrected, assume_unique=True)
+        new = new[~is_archived(ids, new['id'].values)]
+        new = new.drop_duplicates(subset='id', keep='last')
+        new = new[frame.columns] # keep the column order of the csv
+
+        frame = pd.concat([frame, new], ignore_index=True)
+        if corrected.size > 0:
+            frame.to_csv(path, index=False)
+        else:
+            new.to_csv(path, mode='a', header=False, index=False)
+        ids = np.union1d(ids, new['id'].values)
+        np.save(INDEX_PATHS[key], ids)
+
+        state[key] = frame
+        state['ids'][key] = ids
+        added[key] = new
+
+    eps = state['eps']
+    if corrected.size > 0: # samples can't be taken out of a sketch, start over
+        species = pd.MultiIndex.from_arrays([old.loc[corrected, 'country'],
+                                             old.loc[corrected, 'buying_unit']])
+        frame = state['archive_df']
+        rebuild = pd.MultiIndex.from_arrays([frame['country'], frame['buying_unit']])\
+                    .isin(species)
+        species = set(species)
+        for key in [k for k in state['sketches'] if (k[0], k[1]) in species]:
+            del state['sketches'][key]
+        sketch.build(frame[rebuild & ~frame['id'].isin(added['archive_df']['id'])],
+                     eps, state['sketches'])
+    sketch.build(added['archive_df'], eps, state['sketches'])
+    sketch.save(state['sketches'], state['archive_df'].shape[0])
+
+    return int((~archived).sum()), int(corrected.size)
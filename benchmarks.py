@@ -0,0 +1,708 @@
+"""
+Benchmarks and statistical checks on the archived data
+(data/clean_catch_data.csv), using the last day in the archive as "today".
+
+If there is no archive yet, the sampling and profiling checks run on
+synthetic records instead (--rows of them, see catch_rows and catch_fish).
+
+Check that capping the samples per fish (see [sampling] in detection.ini)
+flags the same records as fitting on everything:
+
+    python benchmarks.py sampling --mode month --max-samples 1000 --tolerance 0.05
+
+Measure what the profiling hooks in algorithm.main cost when turned off and
+on (failing if the disabled hooks take more than --max-overhead of the run
+time), and write the per-species profile of one run:
+
+    python benchmarks.py profiling --repeat 3 --max-overhead 0.01
+
+Compare pulling records with a binary COPY (postgres.query_data with
+binary=True) against the csv dump, on synthetic fishdata_catch records served
+by a stand-in connection, and check that both give the same records:
+
+    python benchmarks.py ingestion --rows 200000
+
+Check that the streaming scorer (stream.run) flags the same records as
+scoring them all at once, and that it gets through dropped connections and
+malformed records, against a stand-in server:
+
+    python benchmarks.py stream --rows 20000
+
+Check that rerunning a day after the archive was reloaded from disk doesn't
+take its records for corrected ones, whether the day is pulled through the
+csv dump or a binary COPY:
+
+    python benchmarks.py archive --rows 20000
+
+Check that the quantile sketches (sketch.py) keep the rank error of the
+quartiles within eps, whether samples are added in chunks or sketches are
+merged:
+
+    python benchmarks.py sketch --samples 200000 --eps 0.005
+"""
+import argparse
+import copy
+import json
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import pandas as pd
+import algorithm
+import archive
+import data_clean
+import health
+import models
+import params
+import pgcopy
+import postgres
+import profiling
+import report
+import sketch
+import stream
+
+def split_last_day(archive_df):
+    """
+    Split the archive into its last day of samples and everything before it.
+
+    Returns:
+    df (DataFrame)
+        samples from the last day
+    history (DataFrame)
+        all the other samples
+    """
+    day = archive_df['date'].astype(str).str[:10]
+    last = day.max()
+    return archive_df[day == last], archive_df[day != last]
+
+def flag_all(df, archive_df, fish, date, profiler=profiling.NULL, panels=None):
+    """
+    Helper function. ids flagged by algorithm.main over every country in df.
+    The plot data of the flagged species is added to `panels` if given.
+    """
+    ids = set()
+    for country in df['country'].unique():
+        flagged, c_panels = algorithm.main(df, archive_df, fish, country, date,
+                                           profiler=profiler)
+        if flagged.shape[0] > 0:
+            ids.update(flagged['id'])
+            if panels is not None:
+                panels.extend(c_panels)
+    return ids
+
+def sampling_agreement(df, archive_df, fish, mode='uniform', max_samples=1000,
+                       tolerance=0.05, seed=0, date='benchmark'):
+    """
+    Compare the records flagged with sampling against those flagged when
+    every past sample is used.
+
+    Parameters
+    ----------
+    mode (str)
+        uniform or month
+    max_samples (int)
+        cap on past samples per fish
+    tolerance (float)
+        largest acceptable fraction of flagged records that differ between
+        the two runs (1 - Jaccard similarity)
+
+    Returns:
+    result (dict)
+        'full', 'sampled': number flagged by each run
+        'both': number flagged by both
+        'disagreement': 1 - Jaccard similarity of the flagged sets
+        'ok': whether disagreement <= tolerance
+        'seconds_full', 'seconds_sampled': run times
+    """
+    saved = params.current
+    try:
+        full_params = copy.deepcopy(saved)
+        full_params['sampling']['mode'] = 'off'
+        params.current = full_params
+        start = time.perf_counter()
+        full = flag_all(df, archive_df, fish, date)
+        seconds_full = time.perf_counter() - start
+
+        sampled_params = copy.deepcopy(saved)
+        sampled_params['sampling'] = {'mode': mode, 'max_samples': max_samples,
+                                      'seed': seed}
+        params.current = sampled_params
+        start = time.perf_counter()
+        sampled = flag_all(df, archive_df, fish, date)
+        seconds_sampled = time.perf_counter() - start
+    finally:
+        params.current = saved
+
+    union = full | sampled
+    both = full & sampled
+    disagreement = 0.0 if len(union) == 0 else 1 - len(both)/len(union)
+    return {
+        'full': len(full),
+        'sampled': len(sampled),
+        'both': len(both),
+        'disagreement': disagreement,
+        'ok': disagreement <= tolerance,
+        'seconds_full': seconds_full,
+        'seconds_sampled': seconds_sampled
+    }
+
+def profiling_overhead(df, archive_df, fish, repeat=3, date='benchmark',
+                       max_overhead=0.01):
+    """
+    Time algorithm.main with profiling off and on, and time the hooks of the
+    disabled profiler on their own (the calls algorithm.main makes per fish).
+    The last run with profiling on also draws its report (in a scratch
+    directory), so the profile includes the plotting times.
+
+    Returns:
+    result (dict)
+        'seconds_off', 'seconds_on': best run time over `repeat` runs
+        'hook_seconds_per_fish': cost of the disabled hooks per fish
+        'fish': number of fish profiled in a run
+        'disabled_overhead': hook_seconds_per_fish*fish/seconds_off
+        'ok': whether disabled_overhead <= max_overhead
+    profiler (profiling.Profiler)
+        the profile of the last run with profiling on
+    """
+    seconds_off = []
+    seconds_on = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        flag_all(df, archive_df, fish, date)
+        seconds_off.append(time.perf_counter() - start)
+
+        profiler = profiling.Profiler()
+        panels = []
+        start = time.perf_counter()
+        flag_all(df, archive_df, fish, date, profiler, panels)
+        seconds_on.append(time.perf_counter() - start)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            report.write(panels, date, profiler=profiler)
+        finally:
+            os.chdir(cwd)
+
+    # the calls algorithm.main makes on the profiler for each fish
+    null = profiling.NULL
+    n = 100000
+    start = time.perf_counter()
+    for _ in range(n):
+        null.species('HND', 'fish', 0)
+        with null.section('distance'):
+            null.branch('Mahalanobis')
+        with null.section('thresholding'):
+            pass
+        null.flagged(0)
+    hook = (time.perf_counter() - start)/n
+
+    n_fish = len(profiler.records)
+    result = {
+        'seconds_off': min(seconds_off),
+        'seconds_on': min(seconds_on),
+        'hook_seconds_per_fish': hook,
+        'fish': n_fish,
+        'disabled_overhead': hook*n_fish/min(seconds_off),
+        'ok': hook*n_fish/min(seconds_off) <= max_overhead
+    }
+    return result, profiler
+
+def catch_rows(n, seed=0):
+    """
+    Synthetic raw fishdata_catch records, like the ones in the pg server:
+    id, date (UTC), the json data column and the buyer/buying unit/fisher ids
+    (buying_unit_id has some NULLs). About 1% of the records have a unit
+    price 1000 times too high, so there are outliers to flag.
+    """
+    rng = np.random.default_rng(seed)
+    currencies = ['IDR', 'PHP', 'MZN', 'HNL']
+    names = ['fish%d' % ii for ii in range(50)]
+    price = np.exp(rng.normal(3, 1, n))
+    price[rng.random(n) < 0.01] *= 1000
+    data = [json.dumps({'name': names[a], 'count': int(b), 'weight': round(c, 2),
+                        'weight_units': 'kg', 'price_currency': currencies[d],
+                        'unit_price': round(e, 2), 'total_price': round(c*e, 2)})
+            for a, b, c, d, e in zip(rng.integers(50, size=n),
+                                     rng.integers(1, 20, size=n),
+                                     np.exp(rng.normal(1, 1, n)),
+                                     rng.integers(4, size=n),
+                                     price)]
+    start = np.datetime64('2019-01-01T00:00:00', 'us')
+    buying_unit_id = rng.integers(1, 500, size=n).astype(float)
+    buying_unit_id[rng.random(n) < 0.01] = np.nan
+    return pd.DataFrame({
+        'id': np.arange(1, n + 1, dtype=np.int64),
+        'date': start + np.sort(rng.integers(0, 2*365*86400, size=n))\
+                            .astype('timedelta64[s]'),
+        'data': data,
+        'buyer_id': rng.integers(1, 100, size=n),
+        'buying_unit_id': buying_unit_id,
+        'fisher_id': rng.integers(1, 5000, size=n)
+    })
+
+def catch_fish():
+    """
+    Thresholds for every other species of catch_rows, like a cleaned fish
+    dataset (see clean_fish.main).
+    """
+    fish = pd.DataFrame({'name': ['fish%d' % ii for ii in range(0, 50, 2)]})
+    fish['weight_units'] = 'kg'
+    fish['weight_max'] = 20.0
+    fish['price_min'] = 5.0
+    fish['price_max'] = 100.0
+    return fish
+
+# (name, type oid) of the fishdata_catch columns of catch_rows
+CATCH_COLUMNS = [('id', 20), ('date', 1184), ('data', 3802), ('buyer_id', 23),
+                 ('buying_unit_id', 23), ('fisher_id', 23)]
+
+def date_text(rows):
+    """
+    Helper function. The dates of rows as the pg server writes them out as
+    text (a timestamptz in a UTC session).
+    """
+    return rows['date'].dt.strftime('%Y-%m-%d %H:%M:%S+00')
+
+def copy_binary(rows):
+    """
+    Helper function. rows in the binary COPY format, as the pg server would
+    send them with the data and date columns cast to text.
+    """
+    out = [pgcopy.SIGNATURE, struct.pack('>ii', 0, 0)]
+    for r in zip(rows['id'].tolist(), date_text(rows).tolist(),
+                 rows['data'].tolist(), rows['buyer_id'].tolist(),
+                 rows['buying_unit_id'].tolist(), rows['fisher_id'].tolist()):
+        date = r[1].encode('utf-8')
+        data = r[2].encode('utf-8')
+        out.append(struct.pack('>hiq', 6, 8, r[0]))
+        out.append(struct.pack('>i', len(date)) + date)
+        out.append(struct.pack('>i', len(data)) + data)
+        out.append(struct.pack('>ii', 4, r[3]))
+        if np.isnan(r[4]):
+            out.append(struct.pack('>i', -1))
+        else:
+            out.append(struct.pack('>ii', 4, int(r[4])))
+        out.append(struct.pack('>ii', 4, r[5]))
+    out.append(struct.pack('>h', -1))
+    return b''.join(out)
+
+def copy_csv(rows):
+    """
+    Helper function. rows as the pg server would send them with COPY ... CSV
+    HEADER.
+    """
+    rows = rows.copy()
+    rows['date'] = date_text(rows)
+    rows['buying_unit_id'] = rows['buying_unit_id'].astype('Int64')
+    return rows.to_csv(index=False)
+
+class StandInCursor:
+    """
+    Just enough of a psycopg2 cursor for postgres._query: answers the column
+    type lookup and COPY ... TO STDOUT with precomputed csv or binary output.
+    """
+
+    def __init__(self, payloads):
+        self.payloads = payloads
+        self.description = None
+
+    def execute(self, sql, args=None):
+        self.description = CATCH_COLUMNS
+
+    def copy_expert(self, sql, f):
+        if 'FORMAT binary' in sql:
+            f.write(self.payloads['binary'])
+        else:
+            f.write(self.payloads['csv'])
+
+    def close(self):
+        pass
+
+class StandInConnection:
+    def __init__(self, rows):
+        self.payloads = {'binary': copy_binary(rows), 'csv': copy_csv(rows)}
+
+    def cursor(self):
+        return StandInCursor(self.payloads)
+
+def same_records(csv_data, binary_data):
+    """
+    Helper function. Whether the csv and binary pulls hold the same records.
+    """
+    if csv_data.shape != binary_data.shape or \
+            list(csv_data.columns) != list(binary_data.columns):
+        return False
+    for col in csv_data.columns:
+        a = csv_data[col].values
+        b = binary_data[col].values
+        if not ((a == b) | (pd.isna(a) & pd.isna(b))).all():
+            return False
+    return True
+
+def ingestion(rows, repeat=3):
+    """
+    Time postgres._query pulling rows through the csv dump and through a
+    binary COPY, from a stand-in connection (so only the decoding is timed).
+
+    Returns:
+    result (dict)
+        'rows': number of records
+        'csv_mb', 'binary_mb': size of what the server sends
+        'seconds_csv', 'seconds_binary': best time over `repeat` pulls
+        'rows_per_second_csv', 'rows_per_second_binary'
+        'same': whether both pulls gave the same records
+    """
+    conn = StandInConnection(rows)
+    seconds = {}
+    pulled = {}
+    for binary in [False, True]:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            pulled[binary] = postgres._query(conn, '2021-03-12', binary=binary)
+            times.append(time.perf_counter() - start)
+        seconds[binary] = min(times)
+    n = rows.shape[0]
+    return {
+        'rows': n,
+        'csv_mb': len(conn.payloads['csv'].encode('utf-8'))/1e6,
+        'binary_mb': len(conn.payloads['binary'])/1e6,
+        'seconds_csv': seconds[False],
+        'seconds_binary': seconds[True],
+        'rows_per_second_csv': n/seconds[False],
+        'rows_per_second_binary': n/seconds[True],
+        'same': same_records(pulled[False], pulled[True])
+    }
+
+class StreamStandInCursor:
+    """
+    Just enough of a psycopg2 cursor for stream.fetch_new: serves the records
+    past the watermark, and sets `stop` once there are none left.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+        self.batch = []
+
+    def execute(self, sql, args=None):
+        if self.conn.failures > 0:
+            self.conn.failures -= 1
+            raise ConnectionError("server closed the connection unexpectedly")
+        watermark, limit = args
+        rows = self.conn.rows
+        batch = rows[rows['id'] > watermark].sort_values('id').head(limit)
+        if batch.shape[0] == 0:
+            self.conn.stop.set()
+        self.description = [(col,) for col in batch.columns]
+        self.batch = list(batch.itertuples(index=False, name=None))
+
+    def fetchall(self):
+        return self.batch
+
+    def close(self):
+        pass
+
+class StreamStandIn:
+    """
+    Stand-in for a pg connection (and a pool of them) serving raw catch
+    records to stream.run. The first `failures` queries fail.
+    """
+
+    def __init__(self, rows, stop, failures=0):
+        self.rows = rows
+        self.stop = stop
+        self.failures = failures
+        self.reconnects = 0
+
+    def cursor(self):
+        return StreamStandInCursor(self)
+
+    def rollback(self):
+        pass
+
+    def getconn(self):
+        self.reconnects += 1
+        return self
+
+    def putconn(self, conn, close=False):
+        pass
+
+def stream_check(rows, batch_size=500, failures=2):
+    """
+    Stream the last 20% of rows (raw fishdata_catch records, e.g. from
+    catch_rows) against models fit on the rest, through a stand-in server:
+    once as is, and once with `failures` dropped connections and a malformed
+    record. Run in a scratch directory, so the watermark and logs of the
+    check don't touch ./data and ./logs.
+
+    Returns:
+    result (dict)
+        'expected': number of records flagged when scoring them all at once
+        'clean_run': whether the plain run flagged exactly those
+        'faulty_run': whether the faulty run flagged exactly those outside
+            the malformed record's batch, reached the last record, reported
+            every failure on the health endpoint and reconnected
+        'ok': both runs are right
+    """
+    rows = rows.sort_values('id').reset_index(drop=True)
+    cut = rows['id'].quantile(0.8)
+    history = postgres.clean_postgres_data(rows[rows['id'] < cut].copy())
+    history = data_clean.main(history)
+    fish = catch_fish()
+    state = {'archive_df': history, 'models': models.fit(history, fish)}
+    new = rows[rows['id'] >= cut].reset_index(drop=True)
+    _, scores = stream.score_batch(new.copy(), state)
+    expected = set(scores.loc[scores['flagged'], 'id'])
+
+    def run(conn, pool=None):
+        flagged = set()
+        stream.run(conn, state, lambda d: flagged.update(d['id']),
+                   batch_size=batch_size, poll_seconds=0, stop=conn.stop, pool=pool)
+        return flagged, stream.load_watermark()['id']
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            os.mkdir('data')
+            flagged, last = run(StreamStandIn(new, threading.Event()))
+            clean_run = flagged == expected and last == new['id'].max()
+
+            # a record whose data payload can't be parsed, in the third batch
+            # (or the last one, if there are fewer)
+            first = min(2, (new.shape[0] - 1)//batch_size)*batch_size
+            bad = new.copy()
+            bad.loc[first, 'data'] = '{"name": '
+            skipped = set(bad['id'].values[first:first + batch_size])
+            errors = health.status['stream_errors']
+            os.remove(stream.WATERMARK_PATH)
+            conn = StreamStandIn(bad, threading.Event(), failures)
+            flagged, last = run(conn, conn)
+            faulty_run = flagged == expected - skipped and \
+                last == new['id'].max() and \
+                health.status['stream_errors'] - errors == failures + 1 and \
+                conn.reconnects == failures
+        finally:
+            os.chdir(cwd)
+    return {
+        'expected': len(expected),
+        'clean_run': clean_run,
+        'faulty_run': faulty_run,
+        'ok': clean_run and faulty_run
+    }
+
+def archive_check(rows, binary=False):
+    """
+    Archive the first 80% of rows (raw fishdata_catch records, e.g. from
+    catch_rows), then append the rest as a new day, reload the archive from
+    disk and append the same day again, as a rerun after a restart would.
+    Records are pulled from a stand-in connection like postgres.query_data
+    would: the archive through the csv dump, the day with a binary COPY if
+    `binary`. Run in a scratch directory, so ./data isn't touched.
+
+    Returns:
+    result (dict)
+        'first': (new, corrected) counts of the first append
+        'rerun': the same for the rerun, should be (0, 0)
+        'correction': the same after changing one record's weight in the pg
+            server, should be (0, 1)
+        'ok': all three are right
+    """
+    rows = rows.sort_values('id').reset_index(drop=True)
+    cut = rows['id'].quantile(0.8)
+    day = rows[rows['id'] >= cut].reset_index(drop=True)
+
+    def pull(raw, binary=binary):
+        raw = postgres._query(StandInConnection(raw), '2021-03-12', binary=binary)
+        data = postgres.clean_postgres_data(raw)
+        return data, data_clean.main(data)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            os.mkdir('data')
+            data, df = pull(rows[rows['id'] < cut], False)
+            data.to_csv(archive.ARCHIVE_PATH, index=False)
+            df.to_csv(archive.ARCHIVE_DF_PATH, index=False)
+            pd.DataFrame({'name': ['fish0']}).to_csv(archive.FISH_PATH, index=False)
+
+            state = archive.load(None, None, None, None)
+            first = archive.append(state, *pull(day))
+            state = archive.load(None, None, None, None)
+            rerun = archive.append(state, *pull(day))
+
+            fixed = day.copy()
+            record = json.loads(fixed.loc[0, 'data'])
+            record['weight'] = record['weight'] + 1
+            fixed.loc[0, 'data'] = json.dumps(record)
+            state = archive.load(None, None, None, None)
+            correction = archive.append(state, *pull(fixed))
+        finally:
+            os.chdir(cwd)
+    return {
+        'first': first,
+        'rerun': rerun,
+        'correction': correction,
+        'ok': first == (day.shape[0], 0) and rerun == (0, 0) and \
+            correction == (0, 1)
+    }
+
+def rank_error(sk, samples, q):
+    """
+    Helper function. How far the sketch's q-th quantile(s) are from the exact
+    ones, as a fraction of the samples: 0 if the estimate is an exact q-th
+    quantile of samples (inverted_cdf), otherwise the distance of q to the
+    range of ranks the estimate has.
+    """
+    samples = np.sort(samples)
+    estimate = sk.quantile(q)
+    below = np.searchsorted(samples, estimate, side='left')/samples.size
+    upto = np.searchsorted(samples, estimate, side='right')/samples.size
+    return np.maximum(0, np.maximum(below - q, q - upto))
+
+def sketch_check(n, eps=sketch.DEFAULT_EPS, seeds=10, parts=40):
+    """
+    Check that the quantile sketches keep the rank error of the quartiles
+    the outlier fences use within eps, for n log-normal-ish samples that
+    drift over time (like prices): once added in chunks of random sizes,
+    like daily appends, and once split into `parts` sketches that are merged,
+    like sketch.by_species does. Repeated for `seeds` random streams.
+
+    Returns:
+    result (dict)
+        'eps': the sketches' rank error
+        'chunked', 'merged': worst q25/q75 rank error over all seeds
+        'ok': both are within eps
+    """
+    q = np.array([0.25, 0.75])
+    worst = {'chunked': 0.0, 'merged': 0.0}
+    for seed in range(seeds):
+        rng = np.random.default_rng(seed)
+        samples = rng.normal(0, 1, n) + np.linspace(0, 2, n)
+
+        chunked = sketch.KLL(eps, seed)
+        cuts = np.cumsum(rng.integers(1, 2000, size=n))
+        for chunk in np.split(samples, cuts[cuts < n]):
+            chunked.update(chunk)
+        worst['chunked'] = max(worst['chunked'],
+                               float(rank_error(chunked, samples, q).max()))
+
+        merged = sketch.KLL(eps, seed)
+        for ii, part in enumerate(np.array_split(samples, parts)):
+            sk = sketch.KLL(eps, seeds*(ii + 1) + seed)
+            sk.update(part)
+            merged.merge(sk)
+        worst['merged'] = max(worst['merged'],
+                              float(rank_error(merged, samples, q).max()))
+    return {
+        'eps': eps,
+        'chunked': worst['chunked'],
+        'merged': worst['merged'],
+        'ok': worst['chunked'] <= eps and worst['merged'] <= eps
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+    sampling = sub.add_parser('sampling', help='sampled vs full-data flagged sets')
+    sampling.add_argument('--mode', choices=['uniform', 'month'], default='uniform')
+    sampling.add_argument('--max-samples', type=int, default=1000)
+    sampling.add_argument('--tolerance', type=float, default=0.05)
+    sampling.add_argument('--seed', type=int, default=0)
+    sampling.add_argument('--rows', type=int, default=100000,
+                          help='synthetic records to use if there is no archive')
+    prof = sub.add_parser('profiling', help='profiling hook overhead and profile')
+    prof.add_argument('--repeat', type=int, default=3)
+    prof.add_argument('--max-overhead', type=float, default=0.01,
+                      help='largest acceptable cost of the disabled hooks, '
+                           'as a fraction of the run time')
+    prof.add_argument('--table', default='profile.csv')
+    prof.add_argument('--collapsed', default='profile.folded')
+    prof.add_argument('--rows', type=int, default=100000,
+                      help='synthetic records to use if there is no archive')
+    ingest = sub.add_parser('ingestion', help='binary COPY vs csv dump')
+    ingest.add_argument('--rows', type=int, default=200000)
+    ingest.add_argument('--repeat', type=int, default=3)
+    check_stream = sub.add_parser('stream', help='streaming scorer against a stand-in')
+    check_stream.add_argument('--rows', type=int, default=20000)
+    check_stream.add_argument('--batch-size', type=int, default=500)
+    check_archive = sub.add_parser('archive', help='rerun a day after reloading the archive')
+    check_archive.add_argument('--rows', type=int, default=20000)
+    check_sketch = sub.add_parser('sketch', help='quantile sketch rank error')
+    check_sketch.add_argument('--samples', type=int, default=200000)
+    check_sketch.add_argument('--eps', type=float, default=sketch.DEFAULT_EPS)
+    check_sketch.add_argument('--seeds', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    if args.benchmark == 'stream': # doesn't need the archive
+        result = stream_check(catch_rows(args.rows), args.batch_size)
+        for k, v in result.items():
+            print(k, v)
+        if not result['ok']:
+            sys.exit(1)
+        return
+    if args.benchmark == 'sketch':
+        result = sketch_check(args.samples, args.eps, args.seeds)
+        for k, v in result.items():
+            print(k, v)
+        if not result['ok']:
+            sys.exit(1)
+        return
+    if args.benchmark == 'archive':
+        ok = True
+        for binary in [False, True]:
+            result = archive_check(catch_rows(args.rows), binary)
+            for k, v in result.items():
+                print('binary' if binary else 'csv', k, v)
+            ok = ok and result['ok']
+        if not ok:
+            sys.exit(1)
+        return
+    if args.benchmark == 'ingestion':
+        result = ingestion(catch_rows(args.rows), args.repeat)
+        for k, v in result.items():
+            print(k, v)
+        if not result['same']:
+            sys.exit(1)
+        return
+
+    params.reload()
+    if archive.ARCHIVE_DF_PATH.exists():
+        archive_df = pd.read_csv(str(archive.ARCHIVE_DF_PATH))
+        fish = pd.read_csv(str(archive.FISH_PATH))
+    else:
+        print('no archive at %s, using %d synthetic records'
+              % (archive.ARCHIVE_DF_PATH, args.rows))
+        archive_df = data_clean.main(
+                        postgres.clean_postgres_data(catch_rows(args.rows)))
+        fish = catch_fish()
+
+    if args.benchmark == 'sampling':
+        df, history = split_last_day(archive_df)
+        result = sampling_agreement(df, history, fish, args.mode, args.max_samples,
+                                    args.tolerance, args.seed)
+        for k, v in result.items():
+            print(k, v)
+        if not result['ok']:
+            sys.exit(1)
+    elif args.benchmark == 'profiling':
+        df, history = split_last_day(archive_df)
+        result, profiler = profiling_overhead(df, history, fish, args.repeat,
+                                              max_overhead=args.max_overhead)
+        for k, v in result.items():
+            print(k, v)
+        profiler.write_table(args.table)
+        profiler.write_collapsed(args.collapsed)
+        if not result['ok']:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
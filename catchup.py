@@ -0,0 +1,63 @@
+import json
+from pathlib import Path
+import numpy as np
+
+LAST_DATE_PATH = Path('./data/last_processed_date.json')
+
+def load_last_date():
+    """
+    Get the last day whose records were checked for outliers, or None if no
+    day has been recorded yet.
+    """
+    try:
+        with open(LAST_DATE_PATH) as f:
+            return json.load(f)['date']
+    except FileNotFoundError:
+        return None
+
+def save_last_date(date):
+    with open(LAST_DATE_PATH, 'w') as f:
+        json.dump({'date': date}, f)
+
+def missing_days(yesterday, last=None, max_days=None):
+    """
+    The range of days that haven't been checked yet, i.e. the days after
+    `last` up to and including `yesterday`.
+
+    Parameters
+    ----------
+    yesterday (str)
+        e.g. '2021-03-12', the newest day to check
+    last (str or None)
+        last day checked, from load_last_date; if None only yesterday is
+        missing
+    max_days (int or None)
+        check at most this many days (the most recent ones, at least 1);
+        missed days before those are skipped for good: they are never
+        checked, and their records never make it into the archive
+
+    Returns:
+    days (tuple or None)
+        (first day, last day) to check, both included, or None if every day
+        up to yesterday has been checked
+    """
+    end = np.datetime64(yesterday, 'D')
+    if last is None:
+        start = end
+    else:
+        start = np.datetime64(last, 'D') + np.timedelta64(1, 'D')
+    if max_days is not None:
+        start = max(start, end - np.timedelta64(max_days - 1, 'D'))
+    if start > end:
+        return None
+    return str(start), str(end)
+
+def label(start, end):
+    """
+    Name of a run that checked the days from start to end, used for the report,
+    flagged csv and log file names: the day itself if start == end, otherwise
+    e.g. '2021-03-10_2021-03-12'.
+    """
+    if start == end:
+        return end
+    return start + '_' + end
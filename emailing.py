@@ -41,12 +41,13 @@ def ping(subject, body):
         server.login(from_address, password)
         server.sendmail(from_address, to_address, msg.as_string())
 
-def email_results(email, num_flagged, flagged_path, flagged_fname, images):
+def email_results(email, num_flagged, flagged_path, flagged_fname, report_path,
+                  period='from yesterday'):
     """
     Send an email with the following information:
 
         1. All the information from the flagged records (so the whole rows)
-        2. unit_price vs weight/count log-plots in the form of attachments
+        2. unit_price vs weight/count log-plots, in one html report attachment
 
     Parameters
     ----------
@@ -58,8 +59,12 @@ def email_results(email, num_flagged, flagged_path, flagged_fname, images):
         file path for the csv file containing flagged samples
     flagged_fname: tr
         file name for the csv
-    images: dict[str]
-        dictionary containing file paths for the images of the plots
+    report_path: Path
+        file path for the html report with the plots (see report.py), which
+        may be gzipped
+    period: str
+        the days the records are from, e.g. 'from 2021-03-10 to 2021-03-12'
+        after catching up on missed days
     """
 
     port = 465 #for conntecting to gmail server
@@ -77,12 +82,12 @@ def email_results(email, num_flagged, flagged_path, flagged_fname, images):
     bcc_address = bot_email
     subject = "Potential Outliers Notice"
     body = """
-    Good day! We counted %d record(s) from yesterday flagged as potential outlier(s).
-    Please take a look at the csv/plot data, attached. As a reminder, the plot data is in a shifted log scale, so -1 on the graph means that the value is actually 0.
+    Good day! We counted %d record(s) %s flagged as potential outlier(s).
+    Please take a look at the csv data and the plot report (open it in a web browser), attached. As a reminder, the plot data is in a shifted log scale, so -1 on the graph means that the value is actually 0.
 
     Have a nice day!
     Outlier Bot
-    """ % num_flagged
+    """ % (num_flagged, period)
     receivers = [to_address, bcc_address]
 
     # build the MIMEMultipart object which will later be converted to text
@@ -99,26 +104,17 @@ def email_results(email, num_flagged, flagged_path, flagged_fname, images):
     with open(flagged_path, 'rb') as f:
         msg.attach(MIMEApplication(f.read(), Name=flagged_fname))
 
-    # attach images
-    for n in range(0,len(images)):
-        img_fname = images[n].name
-        img_path = str(images[n])
-        x_attach_id = str(n)
-        content_id = '<' + str(n) + '>'
-
-        with open(img_path, 'rb') as f:
-            # initiate MIME object for img attachment
-            mime = MIMEBase('image', 'png', filename=img_fname)
-
-            # add metadata
-            mime.add_header('Content-disposition', 'attachment', filename=img_fname)
-            mime.add_header('X-attachment-id', x_attach_id)
-            mime.add_header('Content-ID', content_id)
-
-            # prepare the object in format compatible w msg, then attach to msg
-            mime.set_payload(f.read())
-            encoders.encode_base64(mime)
-            msg.attach(mime)
+    # attach the plot report
+    report_fname = report_path.name
+    if report_path.suffix == '.gz':
+        mime = MIMEBase('application', 'gzip', name=report_fname)
+    else:
+        mime = MIMEBase('text', 'html', name=report_fname)
+    with open(report_path, 'rb') as f:
+        mime.set_payload(f.read())
+    encoders.encode_base64(mime)
+    mime.add_header('Content-disposition', 'attachment', filename=report_fname)
+    msg.attach(mime)
 
     with smtplib.SMTP_SSL("smtp.gmail.com", port, context=context) as server:
         server.login(from_address, password)
@@ -0,0 +1,153 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# running tallies for the daemon, served as json on /health and as
+# prometheus-style text on /metrics
+status = {
+    'state': 'starting',
+    'started': time.time(),
+    'runs': 0,
+    'errors': 0,
+    'last_run_start': None,
+    'last_run_end': None,
+    'last_run_seconds': None,
+    'last_success': None,
+    'last_data_date': None,
+    'rows_ingested': 0,
+    'archive_rows': 0,
+    'flagged': 0,
+    # the streaming scorer (stream.run), if it is on; stream_state is None
+    # until it starts, then running or error
+    'stream_state': None,
+    'stream_batches': 0,
+    'stream_rows': 0,
+    'stream_flagged': 0,
+    'stream_errors': 0,
+    'stream_last_batch': None,
+    'stream_last_error': None
+}
+_lock = threading.Lock()
+
+def run_started():
+    with _lock:
+        status['state'] = 'running'
+        status['last_run_start'] = time.time()
+
+def run_finished(date, rows=0, archive_rows=None, flagged=0, error=False):
+    """
+    Record the outcome of one scheduled run.
+
+    Parameters
+    ----------
+    date (str)
+        date of the data that was checked e.g. '2021-03-12'
+    rows (int)
+        number of new records pulled from the pg server
+    archive_rows (int or None)
+        size of the in-memory archive after the update
+    flagged (int)
+        number of records flagged as potential outliers
+    error (bool)
+        whether the run died with an exception
+    """
+    with _lock:
+        now = time.time()
+        status['runs'] += 1
+        status['last_run_end'] = now
+        if status['last_run_start'] is not None:
+            status['last_run_seconds'] = now - status['last_run_start']
+        if error:
+            status['state'] = 'error'
+            status['errors'] += 1
+        else:
+            status['state'] = 'idle'
+            status['last_success'] = now
+            status['last_data_date'] = date
+            status['rows_ingested'] += rows
+            status['flagged'] += flagged
+            if archive_rows is not None:
+                status['archive_rows'] = archive_rows
+
+def stream_started():
+    with _lock:
+        status['stream_state'] = 'running'
+
+def stream_batch(rows, flagged=0):
+    """
+    Record a micro-batch the streaming scorer got through.
+    """
+    with _lock:
+        status['stream_state'] = 'running'
+        status['stream_batches'] += 1
+        status['stream_rows'] += rows
+        status['stream_flagged'] += flagged
+        status['stream_last_batch'] = time.time()
+
+def stream_error(message):
+    """
+    Record a failure of the streaming scorer (lost connection, bad batch...).
+    The stream counts as down until its next successful batch.
+    """
+    with _lock:
+        status['stream_state'] = 'error'
+        status['stream_errors'] += 1
+        status['stream_last_error'] = message
+
+def snapshot():
+    """
+    Copy of status plus how long ago the last successful run finished.
+    """
+    with _lock:
+        snap = dict(status)
+    if snap['last_success'] is None:
+        snap['freshness_seconds'] = None
+    else:
+        snap['freshness_seconds'] = time.time() - snap['last_success']
+    return snap
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        snap = snapshot()
+        if self.path.rstrip('/') in ('', '/health'):
+            body = json.dumps(snap).encode()
+            content_type = 'application/json'
+            code = 503 if 'error' in (snap['state'], snap['stream_state']) else 200
+        elif self.path.rstrip('/') == '/metrics':
+            lines = []
+            for k, v in snap.items():
+                if isinstance(v, (int, float)) and not isinstance(v, bool):
+                    lines.append('outlier_bot_%s %s' % (k, v))
+            lines.append('outlier_bot_up %d' % (snap['state'] != 'error'))
+            if snap['stream_state'] is not None:
+                lines.append('outlier_bot_stream_up %d'
+                             % (snap['stream_state'] != 'error'))
+            body = ('\n'.join(lines) + '\n').encode()
+            content_type = 'text/plain; version=0.0.4'
+            code = 200
+        else:
+            self.send_error(404)
+            return
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # don't spam stdout with every poll
+
+def serve(port=8080, host='127.0.0.1'):
+    """
+    Start the health/metrics endpoint in a background thread.
+
+    Returns:
+    server (ThreadingHTTPServer)
+        call server.shutdown() to stop it
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
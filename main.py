@@ -6,11 +6,22 @@ import schedule
 import numpy as np
 import pandas as pd
 import algorithm
+import archive
+import catchup
 import clean_fish
 import data_clean
 import emailing
 import exception_handling
+import health
+import models
+import parallel
+import params
+import profiling
 import postgres
+import report
+import sketch
+import stream
+import threading
 import configparser
 
 def timestamp(msg):
@@ -18,23 +29,72 @@ def timestamp(msg):
     now = np.datetime64('now') - np.timedelta64(1, 'h')
     print(now,  msg)
 
-def main(host, db, user, password, email, first_run):
+def main(host, db, user, password, email, first_run, state=None, pool=None,
+         processes=1, eps=sketch.DEFAULT_EPS, compress_report=False, profile=False,
+         catch_up=False, max_days=None, binary=False):
+    """
+    Check yesterday's records for outliers and email the results.
 
-    if first_run:
+    With catch_up, every day since the last day checked (see catchup.py) is
+    checked too, e.g. after the host was down for a few days: the missed days
+    are pulled in one query, appended to the archive together, and their
+    records are scored in one pass, with one email for all of them. At most
+    max_days days are checked (all missed days if None); missed days before
+    those are skipped for good, they are neither checked nor archived.
+
+    binary pulls records from the pg server with a binary COPY instead of a
+    csv dump (see postgres.query_data).
+
+    In daemon mode, `state` is the warm archive from archive.load and `pool`
+    is a persistent pg connection pool; both are kept between runs so only
+    the new day's rows are pulled and appended. Run status goes to the health
+    endpoint instead of the daily email ping.
+
+    With processes > 1, countries are checked in parallel (see parallel.main).
+    eps is the rank error of the quantile sketches kept with the archive.
+    compress_report gzips the html report of the flagged species' plots.
+    profile writes per-species timings of the algorithm to ./logs/ (see
+    profiling.py).
+    """
+    daemon = state is not None
+
+    if first_run and not daemon:
         subject = 'opened'
         body = "I'm up!!"
         emailing.ping(subject, body)
 
     # get yesterday's date
-    date = str(np.datetime64('today') - np.timedelta64(1, 'D'))
+    yesterday = str(np.datetime64('today') - np.timedelta64(1, 'D'))
+    start = yesterday
+    if catch_up: # and the days missed since the last run
+        days = catchup.missing_days(yesterday, catchup.load_last_date(), max_days)
+        if days is None:
+            timestamp("I already checked yesterday's data!")
+            if first_run:
+                return schedule.CancelJob
+            else:
+                return True
+        start = days[0]
+    # names the files of this run
+    date = catchup.label(start, yesterday)
+    if start == yesterday:
+        period = 'from yesterday'
+    else:
+        period = 'from %s to %s' % (start, yesterday)
     timestamp("checking for outliers...")
+    if daemon:
+        health.run_started()
 
     try:
-        # get today's records and clean
-        pg_data = postgres.query_data(host, db, user, password, date)
+        # get the records of the days to check and clean
+        pg_data = postgres.query_data(host, db, user, password, start, pool=pool,
+                                      end=yesterday, binary=binary)
         if pg_data.shape[0] == 0:
-            timestamp("There was no data yesterday!")
+            timestamp("There was no data %s!" % period)
             timestamp("I'm done for today. Zzzz.....")
+            catchup.save_last_date(yesterday)
+            if daemon:
+                health.run_finished(date, archive_rows=state['archive_df'].shape[0])
             if first_run:
                 return schedule.CancelJob
             else:
@@ -43,58 +103,74 @@ def main(host, db, user, password, email, first_run):
         # we'll use a 'lite' version of `data` called `df`
         df = data_clean.main(data)
 
-        # load up existing dataset
-        archive_path = Path('./data/pg_data_clean.csv')
-        archive_df_path = Path('./data/clean_catch_data.csv')
-
-        try:
-            archive = pd.read_csv(str(archive_path))
-            archive_df = pd.read_csv(str(archive_df_path))
-            # update our existing clean datasets with today's data
-            # without changing the data we just extracted
-            archive.append(data).to_csv(archive_path, index=False)
-            archive_df.append(df).to_csv(archive_df_path, index=False)
-        # in case its the first run or file was deleted:
-        except FileNotFoundError:
-            pg_archive = postgres.query_data(host, db, user, password)
-            archive = postgres.clean_postgres_data(pg_archive)
-            archive.to_csv(archive_path, index=False)
-            archive_df = data_clean.main(archive)
-            archive_df.to_csv(archive_df_path, index=False)
-
-        # load fish data; eventually set this up like catch data where
-        # the pg server is queried and the raw data is cleaned
-        fishpath = Path('./data/fishdata_buyingunit_clean.csv')
-        fish = pd.read_csv(fishpath)
+        # load up existing dataset, unless we already have it in memory
+        if not daemon:
+            state = archive.load(host, db, user, password, pool=pool, eps=eps,
+                                 binary=binary)
+        archive_df = state['archive_df']
+        fish = state['fish']
+        # update our existing clean datasets with today's data
+        # without changing the data we just extracted
+        archive.append(state, data, df)
+        if daemon: # refresh the cached models for the streaming scorer
+            state['models'] = models.fit(state['archive_df'], fish,
+                                         state['sketches'])
+            models.save(state['models'])
+
         countries = df['country'].unique()
 
         # flagged will hold records flagged as potential outliers, from which we will
         # use the id's to pull from `data` for full context
         flagged = pd.DataFrame()
-        # images is a dict as follows {plot_num: fpath}
-        # to be used for attaching plots to emails
-        images = []
+        # panels hold the plot data of the flagged species,
+        # to be put in the report attached to the email
+        panels = []
+
+        profiler = profiling.Profiler() if profile else profiling.NULL
 
-        for country in countries:
-            c_flagged, c_images = algorithm.main(df, archive_df, fish, country, date)
-            if c_flagged.shape[0] > 0:
-                flagged = flagged.append(c_flagged)
-                images.extend(c_images)
+        if processes > 1 and len(countries) > 1:
+            flagged, panels = parallel.main(df, archive_df, fish, date, processes,
+                                            state['sketches'], profiler)
+        else:
+            sketches = sketch.by_species(state['sketches'])
+            by_country = []
+            for country in countries:
+                c_flagged, c_panels = algorithm.main(df, archive_df, fish, country,
+                                                     date, sketches, profiler)
+                if c_flagged.shape[0] > 0:
+                    by_country.append(c_flagged)
+                    panels.extend(c_panels)
+            if len(by_country) > 0:
+                flagged = pd.concat(by_country)
 
+        num_flagged = 0
         if flagged.shape[0] > 0: # if any samples were flagged
-            timestamp("I found something fishy in yesterday's data!")
+            timestamp("I found something fishy in the data %s!" % period)
             flagged_data = data[data['id'].isin(flagged['id'])]
             num_flagged = flagged_data.shape[0]
             flagged_fname = date+'.csv' # change this eventually
             flagged_path = Path("./flagged_data/"+flagged_fname)
             flagged_data.to_csv(str(flagged_path), index=False)
-            emailing.email_results(email, num_flagged, flagged_path, flagged_fname, images)
+            report_path = report.write(panels, date, compress_report, profiler)
+            emailing.email_results(email, num_flagged, flagged_path, flagged_fname,
+                                   report_path, period)
         else:
-            timestamp("I found nothing fishy in yesterday's data!")
+            timestamp("I found nothing fishy in the data %s!" % period)
 
-        subject = 'daily ping'
-        body = 'still alive!'
-        emailing.ping(subject, body) # daily check if code is live or not
+        if profile: # after the report, which adds the plotting times
+            Path('./logs').mkdir(exist_ok=True)
+            profiler.write_table('./logs/profile_'+date+'.csv')
+            profiler.write_collapsed('./logs/profile_'+date+'.folded')
+        catchup.save_last_date(yesterday)
+
+        if daemon: # the health endpoint tells us the code is live
+            health.run_finished(date, rows=data.shape[0],
+                                archive_rows=state['archive_df'].shape[0],
+                                flagged=num_flagged)
+        else:
+            subject = 'daily ping'
+            body = 'still alive!'
+            emailing.ping(subject, body) # daily check if code is live or not
 
     # in case something goes wrong anywhere in the program, send error log and quit:
     except Exception as e:
@@ -102,6 +178,13 @@ def main(host, db, user, password, email, first_run):
         with open(logpath, 'w') as logf:
             traceback.print_exc(file=logf)
         exception_handling.send_error_log(logpath)
+        if daemon:
+            # stay up so the health endpoint can report the error
+            health.run_finished(date, error=True)
+            timestamp("Something went wrong, I'll try again tomorrow.")
+            if first_run: # the daily job retries, not the startup job
+                return schedule.CancelJob
+            return
         exception_handling.print_error_message()
         quit()
 
@@ -110,54 +193,143 @@ def main(host, db, user, password, email, first_run):
     if first_run:
         return schedule.CancelJob
 
-# for the beginning of the program, initialize things like postgres and email info
-
-login_errors = (psycopg2.errors.InFailedSqlTransaction,
-                psycopg2.OperationalError)
-# for some reason, a wrong password will not cause a problem,
-# data can be queried just fine... not a problem for now I guess
-
-cfg = configparser.ConfigParser()
-cfg.read('config.ini')
-host = cfg.get('postgres', 'host_address')
-db = cfg.get('postgres', 'db_name')
-user = cfg.get('postgres', 'user')
-password = cfg.get('postgres', 'password')
-
-try:
-    # test ping the postgres server
-    postgres.query_data(host, db, user, password, 'test')
-except login_errors:
-    # config.ini info is wrong, prompt user until we have correct info
-    exception_handling.print_error_message('login')
-    host = None
-    db = None
-    user = None
-    password = None
-    while (host is None) or (db is None) or (user is None) or (password is None):
-        host, db, user, password = postgres.login()
-        try:
-            postgres.query_data(host, db, user, password, 'test')
-        except login_errors:
-            exception_handling.print_error_message('login')
-            host = None
-            db = None
-            user = None
-            password = None
-
-# get email address
-email = cfg.read('email', 'user_email')
-while email is None:
-    window_title = "Email",
-    prompt = "Please enter the email address where you would like notifications to go to."
-    email = emailing.ask_email(window_title, prompt)
-
-# scan for outliers in all data up til now as part of the first run
-schedule.every().second.do(main, host, db, user, password, email, True)
-
-# now just scan for outliers once a day
-schedule.every().day.at("00:00").do(main, host, db, user, password, email, False)
-
-while True:
-    schedule.run_pending()
-    time.sleep(1)
+def reload_params(state=None):
+    """
+    Pick up changes to detection.ini without restarting. In daemon mode, only
+    the cached models of the countries affected by the change are refit (and
+    the sketches are rebuilt if the log offset changed); otherwise nothing is
+    cached and the next run simply uses the new parameters.
+    """
+    try:
+        change = params.reload()
+    except (ValueError, configparser.Error) as e:
+        timestamp("detection.ini is invalid, keeping the old parameters: " + str(e))
+        return
+    if change is None:
+        return
+    timestamp("reloaded detection parameters")
+    if state is None:
+        return
+
+    old, new = change
+    countries = params.affected(old, new)
+    if old['log_offset'] != new['log_offset']: # sketches hold log-scale samples
+        state['sketches'] = sketch.build(state['archive_df'], state['eps'])
+        sketch.save(state['sketches'], state['archive_df'].shape[0])
+    if countries is None or len(countries) > 0:
+        state['models'] = models.refit(state['models'], state['archive_df'],
+                                       state['fish'], state['sketches'], countries)
+        models.save(state['models'])
+
+if __name__ == '__main__':
+    # for the beginning of the program, initialize things like postgres and email info
+
+    login_errors = (psycopg2.errors.InFailedSqlTransaction,
+                    psycopg2.OperationalError)
+    # for some reason, a wrong password will not cause a problem,
+    # data can be queried just fine... not a problem for now I guess
+
+    cfg = configparser.ConfigParser()
+    cfg.read('config.ini')
+    host = cfg.get('postgres', 'host_address')
+    db = cfg.get('postgres', 'db_name')
+    user = cfg.get('postgres', 'user')
+    password = cfg.get('postgres', 'password')
+
+    try:
+        # test ping the postgres server
+        postgres.query_data(host, db, user, password, 'test')
+    except login_errors:
+        # config.ini info is wrong, prompt user until we have correct info
+        exception_handling.print_error_message('login')
+        host = None
+        db = None
+        user = None
+        password = None
+        while (host is None) or (db is None) or (user is None) or (password is None):
+            host, db, user, password = postgres.login()
+            try:
+                postgres.query_data(host, db, user, password, 'test')
+            except login_errors:
+                exception_handling.print_error_message('login')
+                host = None
+                db = None
+                user = None
+                password = None
+
+    # get email address
+    email = cfg.read('email', 'user_email')
+    while email is None:
+        window_title = "Email",
+        prompt = "Please enter the email address where you would like notifications to go to."
+        email = emailing.ask_email(window_title, prompt)
+
+    # decode pg records from a binary COPY instead of a csv dump
+    binary = cfg.getboolean('postgres', 'binary_copy', fallback=False)
+
+    # detection parameters; a bad file should stop us here, not at midnight
+    params.reload()
+
+    # rank error of the quantile sketches kept with the archive
+    eps = cfg.getfloat('sketch', 'eps', fallback=sketch.DEFAULT_EPS)
+
+    # gzip the html report attached to the results email
+    compress_report = cfg.getboolean('report', 'compress', fallback=False)
+
+    # record where the algorithm spends its time, per species
+    profile = cfg.getboolean('profiling', 'enabled', fallback=False)
+
+    # daemon mode keeps the archive and a pg connection pool warm between runs
+    # and serves a health/metrics endpoint instead of sending daily pings
+    daemon = cfg.getboolean('daemon', 'enabled', fallback=False)
+    if daemon:
+        health_port = cfg.getint('daemon', 'health_port', fallback=8080)
+        health.serve(health_port)
+        pool = postgres.connection_pool(host, db, user, password)
+        state = archive.load(host, db, user, password, pool=pool, eps=eps,
+                             binary=binary)
+        health.status['archive_rows'] = state['archive_df'].shape[0]
+        state['models'] = models.fit(state['archive_df'], state['fish'],
+                                     state['sketches'])
+        models.save(state['models'])
+
+        # score new records as they come in, between the nightly runs
+        if cfg.getboolean('stream', 'enabled', fallback=False):
+            stream_thread = threading.Thread(target=stream.run, daemon=True,
+                args=(None, state),
+                kwargs={
+                    'pool': pool,
+                    'batch_size': cfg.getint('stream', 'batch_size', fallback=500),
+                    'poll_seconds': cfg.getfloat('stream', 'poll_seconds', fallback=60),
+                    'channel': cfg.get('stream', 'channel', fallback=None)
+                })
+            stream_thread.start()
+    else:
+        pool = None
+        state = None
+
+    # number of countries to check at the same time
+    processes = cfg.getint('parallel', 'processes', fallback=1)
+
+    # also check the days missed while the host was down, up to max_days of them
+    catch_up = cfg.getboolean('catchup', 'enabled', fallback=False)
+    max_days = cfg.getint('catchup', 'max_days', fallback=None)
+    if max_days is not None and max_days < 1: # would never check anything
+        raise ValueError("[catchup] max_days must be at least 1, got %d" % max_days)
+
+    # scan for outliers in all data up til now as part of the first run
+    schedule.every().second.do(main, host, db, user, password, email, True,
+                               state, pool, processes, eps, compress_report, profile,
+                               catch_up, max_days, binary)
+
+    # now just scan for outliers once a day
+    schedule.every().day.at("00:00").do(main, host, db, user, password, email, False,
+                                        state, pool, processes, eps, compress_report,
+                                        profile, catch_up, max_days, binary)
+
+    # check for changes to detection.ini
+    schedule.every().minute.do(reload_params, state)
+
+    while True:
+        schedule.run_pending()
+        time.sleep(1)
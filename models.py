@@ -0,0 +1,267 @@
+import os
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import algorithm
+import params
+
+MODELS_PATH = Path('./data/models.npz')
+_ARRAYS = ['method', 'n', 'mu', 'vi', 'fence', 'bounds', 'limits']
+
+# which rule decides whether a sample is "far", see algorithm.inverse_covariances
+MAHALANOBIS = algorithm.MAHALANOBIS
+IQR_Y = algorithm.IQR_Y
+IQR_X = algorithm.IQR_X
+
+def _log(x):
+    return np.log10(np.asarray(x, dtype=float) + params.current['log_offset'])
+
+def _iqr_bounds(x, sketch=None):
+    if sketch is None or sketch.exact(): # small fish: exact quartiles
+        q1 = np.quantile(x, 0.25)
+        q3 = np.quantile(x, 0.75)
+    else:
+        q1, q3 = sketch.quantile([0.25, 0.75])
+    iqr = q3 - q1
+    return q1 - 1.5*iqr, q3 + 1.5*iqr
+
+def xy(rows):
+    """
+    Log-scale (unit_price, weight) coordinates of every row, where weight is
+    in lbs for HND and kg everywhere else (see algorithm.explanatory_vars).
+
+    Returns:
+    xy (ndarray)
+        shape (len(rows), 2)
+    """
+    weight = np.where(rows['country'].values == 'HND',
+                      rows['weight_lbs'].values, rows['weight_kg'].values)
+    return np.column_stack([_log(rows['unit_price'].values), _log(weight)])
+
+def fit(archive_df, fish, sketches=None, countries=None):
+    """
+    Precompute, for every (country, buying_unit) with enough samples in the
+    archive, everything algorithm.main would need to judge a new sample:
+    the log-scale centroid, the inverse covariance, the Mahalanobis fence
+    (or the IQR bounds when the samples lie on a line) and the thresholds.
+
+    Unlike algorithm.main, samples are grouped by country as well as by
+    buying_unit, and the weight threshold is always compared against the
+    country's weight column.
+
+    Parameters
+    ----------
+    archive_df (DataFrame)
+        All transaction samples, from data_clean.main
+    fish (DataFrame)
+        Cleaned version of fish dataset
+    sketches (dict or None)
+        {(country, buying_unit, col): KLL} from archive.load, used for the
+        IQR bounds instead of the exact quartiles
+    countries (list or None)
+        only fit the fish of these countries (default: all)
+
+    Returns:
+    models (dict)
+        'keys': list of (country, buying_unit)
+        'index': {(country, buying_unit): row in the arrays below}
+        'method': (k,) one of MAHALANOBIS, IQR_Y, IQR_X
+        'n': (k,) number of samples the model was fit on
+        'mu': (k, 2) centroid
+        'vi': (k, 2, 2) inverse covariance (zeros for the IQR methods)
+        'fence': (k,) Mahalanobis distance past which a sample is far
+        'bounds': (k, 2) IQR fences (lower, upper) for the IQR methods
+        'limits': (k, 3) weight max, price min and price max
+    """
+    if sketches is None:
+        sketches = {}
+    archive_df = archive_df.dropna(subset=['buying_unit'])
+    if countries is not None:
+        archive_df = archive_df[archive_df['country'].isin(countries)]
+    fish_limits = fish.drop_duplicates(subset='name').set_index('name')
+
+    groups = [(key, f_df) for key, f_df in
+              archive_df.groupby(['country', 'buying_unit'])
+              if f_df.shape[0] >= params.current['min_samples']]
+    points = [xy(f_df) for _, f_df in groups]
+
+    # covariances and inverses of every fish at once
+    if len(groups) > 0:
+        group = np.repeat(np.arange(len(groups)), [p.shape[0] for p in points])
+        cov = algorithm.covariances(np.concatenate(points), group, len(groups))
+    else:
+        cov = np.empty((0, 2, 2))
+    vi, method = algorithm.inverse_covariances(cov)
+
+    keys = []
+    n = []
+    mu = []
+    fence = []
+    bounds = []
+    limits = []
+    for ii, ((country, fname), f_df) in enumerate(groups):
+        f_xy = points[ii]
+        f_mu = np.nanmean(f_xy, axis=0) # like algorithm.main, skip missing values
+        f_fence = np.nan
+        f_bounds = (np.nan, np.nan)
+        has_limits = fname in fish_limits.index
+
+        ycol = algorithm.explanatory_vars(country)[1]
+        if method[ii] == IQR_Y:
+            f_bounds = _iqr_bounds(f_xy[:, 1], sketches.get((country, fname, ycol)))
+        elif method[ii] == IQR_X:
+            f_bounds = _iqr_bounds(f_xy[:, 0],
+                                   sketches.get((country, fname, 'unit_price')))
+        else:
+            diff = f_xy - f_mu
+            m_dist = np.sqrt(np.maximum(
+                        np.einsum('ni,ij,nj->n', diff, vi[ii], diff), 0))
+            q90 = np.quantile(m_dist, 0.9)
+            f_fence = algorithm.fence_factor(country, has_limits)*q90
+
+        offsets = params.current['default_limit_offsets']
+        f_limits = {k: np.nan for k in offsets}
+        if has_limits:
+            f = fish_limits.loc[fname]
+            f_limits['weight'] = _log(f['weight_max'])
+            f_limits['price_min'] = _log(f['price_min'])
+            f_limits['price_max'] = _log(f['price_max'])
+        for k, (axis, offset) in offsets.items():
+            if np.isnan(f_limits[k]):
+                f_limits[k] = f_mu[axis] + offset
+
+        keys.append((country, fname))
+        n.append(f_df.shape[0])
+        mu.append(f_mu)
+        fence.append(f_fence)
+        bounds.append(f_bounds)
+        limits.append([f_limits['weight'], f_limits['price_min'],
+                       f_limits['price_max']])
+
+    models = {
+        'keys': keys,
+        'index': {key: ii for ii, key in enumerate(keys)},
+        'method': method.astype(int),
+        'n': np.array(n, dtype=int),
+        'mu': np.array(mu, dtype=float).reshape(-1, 2),
+        'vi': vi,
+        'fence': np.array(fence, dtype=float),
+        'bounds': np.array(bounds, dtype=float).reshape(-1, 2),
+        'limits': np.array(limits, dtype=float).reshape(-1, 3)
+    }
+    return models
+
+def refit(models, archive_df, fish, sketches=None, countries=None):
+    """
+    Refit the models of some countries only, e.g. after their detection
+    parameters changed, and keep every other country's models as they are.
+
+    Returns:
+    models (dict)
+        a new dict, same layout as fit
+    """
+    new = fit(archive_df, fish, sketches, countries)
+    if countries is None:
+        return new
+    keep = [ii for ii, key in enumerate(models['keys']) if key[0] not in countries]
+    keys = [models['keys'][ii] for ii in keep] + new['keys']
+    merged = {k: np.concatenate([models[k][keep], new[k]]) for k in _ARRAYS}
+    merged['keys'] = keys
+    merged['index'] = {key: ii for ii, key in enumerate(keys)}
+    return merged
+
+def score(models, rows):
+    """
+    Score a batch of samples against precomputed models, all at once.
+    A sample is flagged if it is far (past the Mahalanobis fence or the IQR
+    bounds), exceeds at least one threshold, and is far enough from the
+    centroid; the same rule algorithm.main uses. Samples whose
+    (country, buying_unit) has no model are never flagged.
+
+    Parameters
+    ----------
+    models (dict)
+        from fit
+    rows (DataFrame)
+        samples with country, buying_unit, unit_price, weight_kg and weight_lbs
+
+    Returns:
+    scores (DataFrame)
+        indexed like rows, with columns
+        'distance': Mahalanobis distance from the centroid (nan for IQR models
+            and samples without a model)
+        'far', 'oob', 'flagged' (bool)
+    """
+    n_rows = rows.shape[0]
+    keys = zip(rows['country'].values, rows['buying_unit'].values)
+    idx = np.fromiter((models['index'].get(key, -1) for key in keys),
+                      dtype=int, count=n_rows)
+    known = idx >= 0
+    ii = idx[known]
+
+    distance = np.full(n_rows, np.nan)
+    far = np.zeros(n_rows, dtype=bool)
+    oob = np.zeros(n_rows, dtype=bool)
+    enough = np.zeros(n_rows, dtype=bool)
+
+    if ii.size > 0:
+        pts = xy(rows[known])
+        x = pts[:, 0]
+        y = pts[:, 1]
+        method = models['method'][ii]
+        mu = models['mu'][ii]
+        diff = pts - mu
+        d = np.sqrt(np.einsum('ni,nij,nj->n', diff, models['vi'][ii], diff))
+        lo = models['bounds'][ii, 0]
+        hi = models['bounds'][ii, 1]
+        is_m = method == MAHALANOBIS
+        k_far = np.where(is_m, d > models['fence'][ii],
+                    np.where(method == IQR_Y, (y < lo) | (y > hi),
+                                              (x < lo) | (x > hi)))
+        lim = models['limits'][ii]
+        k_oob = (y > lim[:, 0]) | (x < lim[:, 1]) | (x > lim[:, 2])
+        margins = params.current['far_enough_margins']
+        k_enough = (np.abs(diff[:, 0]) > margins[0]) | \
+                    (np.abs(diff[:, 1]) > margins[1])
+
+        distance[known] = np.where(is_m, d, np.nan)
+        far[known] = k_far
+        oob[known] = k_oob
+        enough[known] = k_enough
+
+    scores = pd.DataFrame(index=rows.index, data={
+        'distance': distance,
+        'far': far,
+        'oob': oob,
+        'flagged': far & oob & enough
+    })
+    return scores
+
+def save(models, path=MODELS_PATH):
+    """
+    Write models (from fit) to a .npz file so they can be scored against
+    without the archive. The file is replaced in one go, so a reader (e.g.
+    score.py --serve) never sees it half written.
+    """
+    countries = np.array([key[0] for key in models['keys']], dtype=str)
+    names = np.array([key[1] for key in models['keys']], dtype=str)
+    arrays = {k: models[k] for k in _ARRAYS}
+    path = Path(path)
+    tmp = path.with_name(path.stem + '.tmp.npz')
+    np.savez_compressed(tmp, countries=countries, names=names, **arrays)
+    os.replace(tmp, path)
+
+def load(path=MODELS_PATH):
+    """
+    Read models written by save.
+
+    Returns:
+    models (dict)
+        same layout as fit
+    """
+    with np.load(path) as npz:
+        keys = list(zip(npz['countries'].tolist(), npz['names'].tolist()))
+        models = {k: npz[k] for k in _ARRAYS}
+    models['keys'] = keys
+    models['index'] = {key: ii for ii, key in enumerate(keys)}
+    return models
@@ -0,0 +1,217 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+import algorithm
+import params
+import profiling
+import sketch
+
+def share_frame(df):
+    """
+    Copy the columns of a DataFrame into shared memory, one block per column,
+    so that worker processes can read them without pickling the frame.
+    String columns are stored as integer codes; their unique values are small
+    enough to pass along with the spec.
+
+    Returns:
+    spec (dict)
+        {col: (shm name, dtype str, length, uniques or None)}, for attach_frame
+    blocks (list[SharedMemory])
+        close and unlink these when the workers are done (see release)
+    """
+    spec = {}
+    blocks = []
+    for col in df.columns:
+        values = df[col].values
+        uniques = None
+        if values.dtype.kind not in 'biuf': # strings, mixed, nan etc.
+            codes, uniques = pd.factorize(values)
+            values = codes.astype(np.int32)
+            uniques = np.asarray(uniques, dtype=object)
+        values = np.ascontiguousarray(values)
+        shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+        spec[col] = (shm.name, values.dtype.str, values.shape[0], uniques)
+        blocks.append(shm)
+    return spec, blocks
+
+def attach_frame(spec, rows=None):
+    """
+    Rebuild some rows (all if rows is None) of a frame shared by share_frame.
+    The numeric columns are read straight out of the shared blocks when all
+    rows or a slice of them are asked for.
+
+    Parameters
+    ----------
+    spec (dict)
+        from share_frame
+    rows (slice, ndarray[int] or None)
+        positions of the rows to rebuild
+
+    Returns:
+    df (DataFrame)
+    blocks (list[SharedMemory])
+        close these once df is no longer needed
+    """
+    cols = {}
+    blocks = []
+    for col, (name, dtype, length, uniques) in spec.items():
+        shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        values = np.ndarray((length,), dtype=np.dtype(dtype), buffer=shm.buf)
+        if rows is not None:
+            values = values[rows]
+        if uniques is not None: # decode strings, -1 codes are nan
+            if uniques.size == 0:
+                values = np.full(values.shape, np.nan, dtype=object)
+            else:
+                values = np.where(values >= 0,
+                                  uniques.take(values, mode='clip'), np.nan)
+        cols[col] = values
+    return pd.DataFrame(cols), blocks
+
+def release(blocks, unlink=False):
+    for shm in blocks:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+def partition(df, col):
+    """
+    Sort a frame by a column once, and find the slice of rows of each value.
+
+    Returns:
+    df (DataFrame)
+        sorted by col, with a fresh index
+    bounds (dict)
+        {value: (start, stop)}, nan values left out
+    """
+    df = df.sort_values(col, kind='stable').reset_index(drop=True)
+    known = df[col].notna().values
+    values, starts = np.unique(df.loc[known, col].values.astype(str),
+                               return_index=True)
+    stops = np.append(starts[1:], known.sum())
+    bounds = {v: (int(a), int(b)) for v, a, b in zip(values, starts, stops)}
+    return df, bounds
+
+def rows_of(bounds, keys):
+    """
+    Helper function. Positions of the rows of every key in bounds (from
+    partition), in one array.
+    """
+    ranges = [np.arange(*bounds[k]) for k in keys if k in bounds]
+    if len(ranges) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(ranges)
+
+def pool_context():
+    """
+    Multiprocessing context for the worker pool. Workers are never forked
+    straight from the caller, which may have threads running (the daemon's
+    health endpoint and streaming scorer): they come from a forkserver where
+    there is one, and are spawned otherwise. The forkserver imports algorithm
+    once, so each worker doesn't have to (it finds it through the working
+    directory, which main.py already needs to be the repo).
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload(['algorithm', 'parallel'])
+        return ctx
+    return multiprocessing.get_context('spawn')
+
+def _run_country(df_spec, archive_spec, df_rows, archive_rows, fish, country,
+                 date, sketches, detection_params, profile):
+    """
+    Helper function for main. Runs algorithm.main for one country, on the rows
+    of the species it checks.
+    """
+    params.current = detection_params # in case the worker wasn't forked
+    profiler = profiling.Profiler() if profile else profiling.NULL
+    df, df_blocks = attach_frame(df_spec, df_rows)
+    archive_df, archive_blocks = attach_frame(archive_spec, archive_rows)
+    flagged, panels = algorithm.main(df, archive_df, fish, country, date, sketches,
+                                     profiler)
+    del df, archive_df # drop the views before closing the blocks
+    release(df_blocks + archive_blocks)
+    return flagged, panels, profiler.records
+
+def main(df, archive_df, fish, date, processes=None, sketches=None,
+         profiler=profiling.NULL):
+    """
+    Run algorithm.main for every country in df at the same time, one worker
+    process per country, with the same results as calling it for each country
+    in turn. Today's samples and the archive are sorted by species once and
+    put in shared memory, so each worker only reads the samples of the
+    species its country has today (from every country, as algorithm.main
+    fits a species on all of its samples) instead of being sent (and
+    rescanning) the whole archive.
+
+    Parameters
+    ----------
+    df (DataFrame)
+        Today's transaction samples.
+    archive_df (DataFrame)
+        All transaction samples.
+    fish (DataFrame)
+        Cleaned version of fish dataset
+    date (str)
+        e.g. '2021-03-12'
+    processes (int or None)
+        most countries to run at once; defaults to one per country
+    sketches (dict or None)
+        {(country, buying_unit, col): KLL} from archive.load, merged over the
+        countries like in a serial run (see sketch.by_species)
+    profiler (profiling.Profiler)
+        gets the per-fish timings recorded by the workers
+
+    Returns:
+    flagged (DataFrame)
+        Subset of df containing potential outliers, from all countries.
+    panels (list[dict])
+        plot data from all countries, for report.write
+    """
+    countries = df['country'].unique()
+    df, df_bounds = partition(df, 'buying_unit')
+    archive_df, archive_bounds = partition(archive_df, 'buying_unit')
+    df_spec, df_blocks = share_frame(df)
+    archive_spec, archive_blocks = share_frame(archive_df)
+    if sketches is not None:
+        sketches = sketch.by_species(sketches)
+
+    flagged = []
+    panels = []
+    try:
+        with ProcessPoolExecutor(max_workers=processes or len(countries),
+                                 mp_context=pool_context()) as pool:
+            futures = []
+            for country in countries:
+                names = df.loc[df['country'] == country, 'buying_unit']\
+                            .dropna().unique().astype(str)
+                if names.size == 0: # nothing algorithm.main could check
+                    continue
+                c_sketches = None
+                if sketches is not None:
+                    c_sketches = {k: v for k, v in sketches.items()
+                                  if k[0] in names}
+                futures.append(pool.submit(_run_country, df_spec, archive_spec,
+                                           rows_of(df_bounds, names),
+                                           rows_of(archive_bounds, names),
+                                           fish, country, date, c_sketches,
+                                           params.current,
+                                           profiler is not profiling.NULL))
+            for future in futures: # keep the order of the countries
+                c_flagged, c_panels, c_records = future.result()
+                profiler.records.extend(c_records)
+                if c_flagged.shape[0] > 0:
+                    flagged.append(c_flagged)
+                    panels.extend(c_panels)
+    finally:
+        release(df_blocks + archive_blocks, unlink=True)
+
+    if len(flagged) > 0:
+        flagged = pd.concat(flagged)
+    else:
+        flagged = pd.DataFrame()
+    return flagged, panels
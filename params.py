@@ -0,0 +1,204 @@
+import configparser
+import copy
+import os
+from pathlib import Path
+
+PARAMS_PATH = Path('./detection.ini')
+COUNTRIES = ['HND', 'IDN', 'MOZ', 'PHL']
+
+DEFAULTS = {
+    # added to every value before taking log10 to avoid log(0)
+    'log_offset': 1e-1,
+    # fish with fewer samples than this in the archive are not checked
+    'min_samples': 10,
+    # fish whose log-scale prices (or weights) have a smaller variance than
+    # this are treated as having no spread in that direction, and are judged by
+    # the 1D IQR rule instead of the Mahalanobis distance
+    'min_variance': 1e-12,
+    # price-weight correlations are capped at this size before the covariance
+    # is inverted, so that nearly collinear fish still get a stable inverse
+    'max_correlation': 0.999,
+    # flagged points must be at least this far from the centroid (log-scale)
+    # in x or y, see algorithm.far_enough
+    'far_enough_margins': (0.5, 1.0),
+    # when a fish has no threshold on record, the threshold is placed this far
+    # from the centroid (log-scale): (which coordinate of mu, offset)
+    'default_limit_offsets': {
+        'weight': (1, 2.0),
+        'price_min': (0, -1.5),
+        'price_max': (0, 1.5)
+    },
+    # multiple of the 90th percentile Mahalanobis distance past which a sample
+    # is far, for fish with and without thresholds on record
+    'fence_factor': {
+        'limits': {'HND': 2.0, 'IDN': 1.5, 'MOZ': 2.0, 'PHL': 2.0},
+        'no_limits': {'HND': 1.5, 'IDN': 2.0, 'MOZ': 2.0, 'PHL': 2.5}
+    },
+    # cap on the past samples a fish's centroid, covariance and fence are fit
+    # on, see algorithm.sample_history; mode is off, uniform or month
+    'sampling': {
+        'mode': 'off',
+        'max_samples': 5000,
+        'seed': 0
+    }
+}
+
+# the parameters in use; replaced (never modified) by reload
+current = copy.deepcopy(DEFAULTS)
+_mtime = None
+
+def _positive(section, key, value):
+    if not value > 0:
+        raise ValueError("[%s] %s must be positive, got %s" % (section, key, value))
+    return value
+
+def parse(cfg):
+    """
+    Read and validate detection parameters from a ConfigParser. Anything not in
+    the file keeps its default. The layout is
+
+        [general]
+        log_offset = 0.1
+        min_samples = 10
+        min_variance = 1e-12
+        max_correlation = 0.999
+        far_enough_price = 0.5
+        far_enough_weight = 1
+        default_weight_offset = 2
+        default_price_min_offset = -1.5
+        default_price_max_offset = 1.5
+
+        [fence_factor_limits]
+        HND = 2
+        ...
+
+        [fence_factor_no_limits]
+        HND = 1.5
+        ...
+
+        [sampling]
+        mode = off
+        max_samples = 5000
+        seed = 0
+
+    Returns:
+    params (dict)
+        same layout as DEFAULTS
+
+    Raises ValueError if a value is malformed or out of range.
+    """
+    p = copy.deepcopy(DEFAULTS)
+    g = 'general'
+    if cfg.has_section(g):
+        p['log_offset'] = _positive(g, 'log_offset',
+            cfg.getfloat(g, 'log_offset', fallback=p['log_offset']))
+        p['min_samples'] = cfg.getint(g, 'min_samples', fallback=p['min_samples'])
+        if p['min_samples'] < 3: # need a covariance and a 90th percentile
+            raise ValueError("[general] min_samples must be at least 3, got %d"
+                             % p['min_samples'])
+        p['min_variance'] = _positive(g, 'min_variance',
+            cfg.getfloat(g, 'min_variance', fallback=p['min_variance']))
+        p['max_correlation'] = _positive(g, 'max_correlation',
+            cfg.getfloat(g, 'max_correlation', fallback=p['max_correlation']))
+        if p['max_correlation'] >= 1:
+            raise ValueError("[general] max_correlation must be below 1, got %s"
+                             % p['max_correlation'])
+        margins = p['far_enough_margins']
+        p['far_enough_margins'] = (
+            cfg.getfloat(g, 'far_enough_price', fallback=margins[0]),
+            cfg.getfloat(g, 'far_enough_weight', fallback=margins[1]))
+        if min(p['far_enough_margins']) < 0:
+            raise ValueError("[general] far_enough margins can't be negative")
+        for k, (axis, offset) in DEFAULTS['default_limit_offsets'].items():
+            key = 'default_%s_offset' % k
+            p['default_limit_offsets'][k] = (axis, cfg.getfloat(g, key, fallback=offset))
+        if p['default_limit_offsets']['price_min'][1] > \
+                p['default_limit_offsets']['price_max'][1]:
+            raise ValueError("[general] default_price_min_offset is above "
+                             "default_price_max_offset")
+
+    for kind in ['limits', 'no_limits']:
+        section = 'fence_factor_' + kind
+        if not cfg.has_section(section):
+            continue
+        for country, value in cfg.items(section):
+            country = country.upper()
+            if country not in COUNTRIES:
+                raise ValueError("[%s] unknown country %s" % (section, country))
+            try:
+                value = float(value)
+            except ValueError:
+                raise ValueError("[%s] %s is not a number: %s"
+                                 % (section, country, value))
+            p['fence_factor'][kind][country] = _positive(section, country, value)
+
+    if cfg.has_section('sampling'):
+        sampling = p['sampling']
+        sampling['mode'] = cfg.get('sampling', 'mode', fallback=sampling['mode'])
+        if sampling['mode'] not in ['off', 'uniform', 'month']:
+            raise ValueError("[sampling] mode must be off, uniform or month, got %s"
+                             % sampling['mode'])
+        sampling['max_samples'] = cfg.getint('sampling', 'max_samples',
+                                             fallback=sampling['max_samples'])
+        if sampling['max_samples'] < p['min_samples']:
+            raise ValueError("[sampling] max_samples can't be below min_samples")
+        sampling['seed'] = cfg.getint('sampling', 'seed', fallback=sampling['seed'])
+    return p
+
+def load(path=PARAMS_PATH):
+    """
+    Read detection parameters from an ini file (defaults if it doesn't exist).
+    """
+    cfg = configparser.ConfigParser()
+    cfg.optionxform = str # keep country codes as written
+    cfg.read(path)
+    return parse(cfg)
+
+def affected(old, new):
+    """
+    Which countries' cached per-species results (models, sketches) are out of
+    date after the parameters change from old to new.
+
+    Returns:
+    countries (set or None)
+        None if every country is affected, otherwise the set of countries
+        (empty if nothing cached depends on what changed)
+    """
+    for key in ['log_offset', 'min_samples', 'min_variance', 'max_correlation',
+                'default_limit_offsets']:
+        if old[key] != new[key]:
+            return None
+    # far_enough_margins are only used when scoring and sampling only in
+    # algorithm.main, nothing cached to redo
+    countries = set()
+    for kind in ['limits', 'no_limits']:
+        for country in COUNTRIES:
+            if old['fence_factor'][kind][country] != new['fence_factor'][kind][country]:
+                countries.add(country)
+    return countries
+
+def reload(path=PARAMS_PATH):
+    """
+    Re-read the parameters if the file changed since the last (re)load. If the
+    new file is invalid, the current parameters stay in place.
+
+    Returns:
+    change (tuple or None)
+        (old params, new params) if the parameters changed, otherwise None
+
+    Raises ValueError if the file is invalid.
+    """
+    global current, _mtime
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        mtime = None
+    if mtime == _mtime:
+        return None
+    _mtime = mtime # a bad file is only reported once
+    new = load(path)
+    if new == current:
+        return None
+    old = current
+    current = new
+    return old, new
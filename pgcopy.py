@@ -0,0 +1,169 @@
+"""
+Decoder for the binary format of postgres COPY (COPY ... TO STDOUT
+(FORMAT binary)), so query results can go straight into numpy arrays without
+being written out and parsed as csv text.
+
+The stream is a header, then one tuple per row: a 16-bit field count, and for
+every field a 32-bit length (-1 for NULL) followed by that many bytes, all
+big-endian. Numbers, booleans, dates and timestamps are decoded from their
+binary form; every other type is cast to text in the query (see select_list)
+and comes back as str.
+"""
+import struct
+from array import array
+import numpy as np
+import pandas as pd
+
+SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+TEXT = 25 # type oid of text
+
+# type oid: (wire format, dtype of the decoded column)
+FIXED = {
+    16: ('?', np.bool_), # bool
+    20: ('>i8', np.int64), # int8
+    21: ('>i2', np.int16), # int2
+    23: ('>i4', np.int32), # int4
+    700: ('>f4', np.float32), # float4
+    701: ('>f8', np.float64), # float8
+    1082: ('>i4', 'datetime64[D]'), # date, days since 2000-01-01
+    1114: ('>i8', 'datetime64[us]'), # timestamp, microseconds since 2000-01-01
+    1184: ('>i8', 'datetime64[us]') # timestamptz, same but always UTC
+}
+# dates and timestamps count from here
+PG_EPOCH = np.datetime64('2000-01-01T00:00:00', 'us')
+
+_int16 = struct.Struct('>h').unpack_from
+_int32 = struct.Struct('>i').unpack_from
+
+def select_list(description, text=()):
+    """
+    Select list for a binary COPY of a query's columns: columns of a type in
+    FIXED are copied as they are, all others are cast to text.
+
+    Parameters
+    ----------
+    description (sequence)
+        cursor.description of the query, (name, type oid, ...) per column
+    text (collection)
+        names of columns to cast to text even if their type is in FIXED
+
+    Returns:
+    select (str)
+        e.g. '"id", "date", "data"::text AS "data"'
+    oids (list[int])
+        type oid of each column as it will be copied
+    """
+    select = []
+    oids = []
+    for col in description:
+        name = '"%s"' % col[0].replace('"', '""')
+        if col[1] in FIXED and col[0] not in text:
+            select.append(name)
+            oids.append(col[1])
+        else:
+            select.append('%s::text AS %s' % (name, name))
+            oids.append(TEXT)
+    return ', '.join(select), oids
+
+def scan(buf, n_cols):
+    """
+    Find where every field starts in a binary COPY stream, and its length.
+
+    Returns:
+    starts (ndarray[int64])
+        (rows, n_cols) offset of each field's data in buf
+    lengths (ndarray[int32])
+        (rows, n_cols) length of each field, -1 for NULL
+    """
+    if buf[:len(SIGNATURE)] != SIGNATURE:
+        raise ValueError("not a binary COPY stream")
+    ext, = _int32(buf, len(SIGNATURE) + 4) # header extension, skipped
+    pos = len(SIGNATURE) + 8 + ext
+    first = pos
+
+    # only the lengths are collected here, the starts follow from them
+    lengths = array('i')
+    append = lengths.append
+    fields = range(n_cols)
+    rows = 0
+    while True:
+        n, = _int16(buf, pos)
+        pos += 2
+        if n == -1: # trailer
+            break
+        if n != n_cols:
+            raise ValueError("expected %d fields per row, got %d" % (n_cols, n))
+        rows += 1
+        for _ in fields:
+            length, = _int32(buf, pos)
+            append(length)
+            if length > 0:
+                pos += 4 + length
+            else:
+                pos += 4
+    lengths = np.frombuffer(lengths, dtype=np.int32).reshape(rows, n_cols)
+
+    # every field starts after the one before it, its 4 byte length, and the
+    # 2 byte field count at the start of each row
+    sizes = np.maximum(lengths, 0)
+    step = sizes.astype(np.int64) + 4
+    step[:, 0] += 2
+    starts = np.cumsum(step.ravel()).reshape(rows, n_cols) + first - sizes
+    return starts, lengths
+
+def _fixed(raw, starts, null, oid):
+    """
+    Helper function for decode. Gather a fixed-width column into one array and
+    convert it from the wire format.
+    """
+    wire, dtype = FIXED[oid]
+    width = np.dtype(wire).itemsize
+    # NULL fields have no data, read the first byte instead and mask it below
+    idx = np.where(null, 0, starts)[:, None] + np.arange(width)
+    values = raw[idx].view(wire).ravel()
+    if oid == 1082:
+        col = PG_EPOCH.astype('datetime64[D]') + values.astype('timedelta64[D]')
+    elif oid in (1114, 1184):
+        col = PG_EPOCH + values.astype('timedelta64[us]')
+    else:
+        col = values.astype(dtype)
+    if null.any():
+        if col.dtype.kind == 'M':
+            col[null] = np.datetime64('NaT')
+        else: # like read_csv, columns with missing numbers are float
+            col = col.astype(float)
+            col[null] = np.nan
+    return col
+
+def decode(buf, names, oids):
+    """
+    Decode a binary COPY stream into a DataFrame with one typed column per
+    field: ints, floats and bools as numpy numbers (float with nan if there
+    are NULLs), dates and timestamps as datetime64 (NaT for NULL) and text as
+    str (nan for NULL).
+
+    Parameters
+    ----------
+    buf (bytes)
+        output of COPY ... TO STDOUT (FORMAT binary)
+    names (list[str])
+        column names
+    oids (list[int])
+        type oid of each column, from select_list
+
+    Returns:
+    frame (DataFrame)
+    """
+    starts, lengths = scan(buf, len(names))
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    cols = {}
+    for j, (name, oid) in enumerate(zip(names, oids)):
+        null = lengths[:, j] < 0
+        if oid in FIXED:
+            cols[name] = _fixed(raw, starts[:, j], null, oid)
+        else:
+            col = np.empty(starts.shape[0], dtype=object)
+            col[:] = [buf[s:s+n].decode('utf-8') if n >= 0 else np.nan
+                      for s, n in zip(starts[:, j].tolist(), lengths[:, j].tolist())]
+            cols[name] = col
+    return pd.DataFrame(cols, columns=names)
@@ -1,4 +1,6 @@
 import psycopg2
+import psycopg2.pool
+import io
 from pathlib import Path
 import tkinter as tk
 import tkinter.simpledialog as simpledialog
@@ -6,6 +8,7 @@ import ast
 import pandas as pd
 import numpy as np
 from clean_fish import fix_weight_units
+import pgcopy
 
 def prompt_user(window_title, prompt, for_password=False):
     """
@@ -46,16 +49,65 @@ def login():
 
     return host, db, user, password
 
-def query_data(host, db, user, password, date=None):
+def connection_pool(host, db, user, password, maxconn=2):
     """
-    query yesterday's catch data and write it out to a csv
+    Open a pool of pg connections that stays up between scheduled runs, so the
+    daemon doesn't have to reconnect to the server every night.
+
+    Returns:
+    pool (ThreadedConnectionPool)
+        pass this to query_data as `pool`
     """
-    conn = psycopg2.connect(
+    return psycopg2.pool.ThreadedConnectionPool(
+        1, maxconn,
         host=host,
         database=db,
         user=user,
         password=password)
 
+def query_data(host, db, user, password, date=None, pool=None, end=None,
+               binary=False):
+    """
+    query yesterday's catch data and write it out to a csv
+
+    If `end` is given, the records of every day from `date` to `end` (both
+    included) are fetched in one query, e.g. to catch up after downtime.
+
+    If `pool` is given, a connection is borrowed from it and handed back
+    afterwards instead of opening and closing a new one.
+
+    With binary, the records are copied in postgres' binary format and decoded
+    straight into typed columns (see pgcopy.py) instead of going through a csv
+    file. The date column is still sent as text, in the same form as in the
+    csv dump, so records compare equal to their archived version.
+    """
+    if pool is None:
+        conn = psycopg2.connect(
+            host=host,
+            database=db,
+            user=user,
+            password=password)
+    else:
+        conn = pool.getconn()
+
+    try:
+        return _query(conn, date, end, binary)
+    except psycopg2.OperationalError:
+        if pool is not None: # don't hand a dead connection back to the pool
+            pool.putconn(conn, close=True)
+            conn = None
+        raise
+    finally:
+        if conn is not None:
+            if pool is None:
+                conn.close()
+            else:
+                pool.putconn(conn)
+
+def _query(conn, date, end=None, binary=False):
+    """
+    Helper function for query_data. Runs the query on an open connection.
+    """
     cur = conn.cursor()
     if date is None: # if there is no archived data already
         date = '2019-01-01'
@@ -65,11 +117,17 @@ def query_data(host, db, user, password, date=None):
         sql = "SELECT * FROM fishdata_catch LIMIT 1"
         cur.execute(sql) # this will fail if login info is wrong
         cur.close()
-        conn.close()
         return None
-    else:
+    elif end is None or end == date:
         sql = """SELECT * FROM fishdata_catch
         WHERE date::date = \'{}\'""".format(date)
+    else:
+        sql = """SELECT * FROM fishdata_catch
+        WHERE date::date BETWEEN \'{}\' AND \'{}\'""".format(date, end)
+    if binary:
+        pg_data = _copy_binary(cur, sql)
+        cur.close()
+        return pg_data
     copy_sql = "COPY ("+sql+") TO STDOUT WITH CSV HEADER"
     csv_path = Path('./data/postgres_dump.csv')
 
@@ -78,10 +136,24 @@ def query_data(host, db, user, password, date=None):
         cur.copy_expert(copy_sql, f)
 
     cur.close()
-    conn.close()
 
     return pd.read_csv(str(csv_path), engine='python')
 
+def _copy_binary(cur, sql):
+    """
+    Helper function for _query. Copy the result of sql in binary format and
+    decode it into a DataFrame. The column types are looked up first, so that
+    the columns pgcopy can't decode (e.g. the json `data` column) are copied
+    as text. So is the date, which the archive keeps as the server's text.
+    """
+    cur.execute("SELECT * FROM ("+sql+") AS q LIMIT 0")
+    names = [col[0] for col in cur.description]
+    select, oids = pgcopy.select_list(cur.description, text=['date'])
+    copy_sql = "COPY (SELECT "+select+" FROM ("+sql+") AS q) TO STDOUT (FORMAT binary)"
+    buf = io.BytesIO()
+    cur.copy_expert(copy_sql, buf)
+    return pgcopy.decode(buf.getvalue(), names, oids)
+
 def unravel(row_data):
     """
     Helper function for clean_postgres_data.
@@ -179,6 +251,7 @@ def clean_postgres_data(pg_data):
     pg_data['weight_kg'] = pg_data['weight']*kg_conv
     pg_data['weight_lbs'] = pg_data['weight']*lbs_conv
 
-    pg_data = pg_data[~pg_data.duplicated()]
+    # records are unique by id; a record that shows up twice keeps its last copy
+    pg_data = pg_data.drop_duplicates(subset='id', keep='last')
 
     return pg_data
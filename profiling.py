@@ -0,0 +1,134 @@
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+SECTIONS = ['distance', 'thresholding', 'plotting']
+
+class Profiler:
+    """
+    Records where algorithm.main spends its time, per (country, buying_unit):
+    row count, which method found the far points, time spent in distance
+    computation, thresholding and plotting (collecting the plot data, and
+    drawing it if report.write is given the profiler), and the number
+    flagged.
+
+    Pass one to algorithm.main as `profiler`; leave it out (or use NULL) to
+    turn profiling off.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._current = None
+
+    def species(self, country, fname, rows):
+        """
+        Start recording a new fish. Later calls go to this fish's record.
+        """
+        self._current = {
+            'country': country,
+            'buying_unit': fname,
+            'rows': rows,
+            'branch': None,
+            'distance': 0.0,
+            'thresholding': 0.0,
+            'plotting': 0.0,
+            'flagged': 0
+        }
+        self.records.append(self._current)
+
+    def branch(self, name):
+        self._current['branch'] = name
+
+    def flagged(self, n):
+        self._current['flagged'] = n
+
+    @contextmanager
+    def section(self, name):
+        """
+        Time a block of code and add it to the current fish's `name` section.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._current[name] += time.perf_counter() - start
+
+    @contextmanager
+    def section_of(self, country, fname, name):
+        """
+        Time a block of code and add it to the `name` section of a fish
+        recorded earlier, for work done on it after algorithm.main returned
+        (e.g. drawing its plot in report.write).
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            for r in reversed(self.records):
+                if r['country'] == country and r['buying_unit'] == fname:
+                    r[name] += seconds
+                    break
+
+    def table(self):
+        """
+        Returns:
+        table (DataFrame)
+            one row per fish, slowest first; times in seconds
+        """
+        table = pd.DataFrame(self.records, columns=['country', 'buying_unit',
+                    'rows', 'branch'] + SECTIONS + ['flagged'])
+        table['total'] = table[SECTIONS].sum(axis=1)
+        return table.sort_values('total', ascending=False)
+
+    def write_table(self, path):
+        self.table().to_csv(path, index=False)
+
+    def write_collapsed(self, path):
+        """
+        Write the timings as collapsed stacks (country;buying_unit;branch;section
+        microseconds, one per line), the input format of flamegraph.pl and
+        speedscope.
+        """
+        with open(path, 'w') as f:
+            for r in self.records:
+                for name in SECTIONS:
+                    us = int(round(r[name]*1e6))
+                    if us > 0:
+                        frames = [r['country'], str(r['buying_unit']),
+                                  str(r['branch']), name]
+                        # ; separates frames and space ends the stack
+                        frames = [s.replace(';', ',').replace(' ', '_') for s in frames]
+                        f.write('%s %d\n' % (';'.join(frames), us))
+
+class _NullProfiler:
+    """
+    Does nothing. Used by algorithm.main when profiling is off, so the hot
+    path doesn't need any `if profiling` checks.
+    """
+    records = []
+
+    def species(self, country, fname, rows):
+        pass
+
+    def branch(self, name):
+        pass
+
+    def flagged(self, n):
+        pass
+
+    def section(self, name):
+        return _NULL_SECTION
+
+    def section_of(self, country, fname, name):
+        return _NULL_SECTION
+
+class _NullSection:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SECTION = _NullSection()
+NULL = _NullProfiler()
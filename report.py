@@ -0,0 +1,205 @@
+import gzip
+import html
+import numpy as np
+from pathlib import Path
+import profiling
+
+# most background samples drawn per species; flagged/far/oob are always drawn
+MAX_POINTS = 400
+WIDTH = 420
+HEIGHT = 320
+MARGIN = (40, 12, 14, 40) # left, right, top, bottom
+
+def panel(country, fname, ycol, f_df, mu, far, oob, limits, n_flagged, seed=0):
+    """
+    Collect what a species' plot needs: the samples, the centroid, `far` and
+    `oob` points and the thresholds. The background samples are decimated to MAX_POINTS.
+
+    Parameters
+    ----------
+    country (str)
+    fname (str)
+        buying_unit
+    ycol (str)
+        either weight_kg or weight_lbs
+    f_df (DataFrame)
+        log-scale samples for the current fish
+    mu (Series)
+        centroid of samples
+    far (DataFrame)
+        samples that exceed Mahalanobis fence
+    oob (DataFrame)
+        samples that exceed thresholds
+    limits (dict[float])
+        log-scale thresholds
+    n_flagged (int)
+        number of samples flagged
+
+    Returns:
+    panel (dict)
+    """
+    x = f_df['unit_price'].values
+    y = f_df[ycol].values
+    if x.size > MAX_POINTS:
+        rng = np.random.default_rng(seed)
+        keep = rng.choice(x.size, MAX_POINTS, replace=False)
+        x = x[keep]
+        y = y[keep]
+    return {
+        'country': country,
+        'buying_unit': fname,
+        'title': "country=%s, buying_unit=%s" % (country, fname),
+        'subtitle': "%d potential outlier(s) (n=%d)" % (n_flagged, f_df.shape[0]),
+        'ycol': ycol,
+        'x': x,
+        'y': y,
+        'mu': (float(mu.iloc[0]), float(mu.iloc[1])),
+        'far': (far['unit_price'].values, far[ycol].values),
+        'oob': (oob['unit_price'].values, oob[ycol].values),
+        'limits': dict(limits)
+    }
+
+def _ticks(lo, hi, n=5):
+    step = 10**np.floor(np.log10((hi - lo)/n))
+    for m in (1, 2, 5, 10):
+        if (hi - lo)/(m*step) <= n:
+            step = m*step
+            break
+    ticks = np.arange(np.ceil(lo/step)*step, hi + step/2, step)
+    return ticks[ticks <= hi]
+
+def svg(p):
+    """
+    Draw a panel as a small inline svg: background samples as dots, centroid as
+    a red star, far points as magenta +, oob points as green x, and the areas
+    past the thresholds shaded (red for price, blue for weight).
+    """
+    xs = np.concatenate([p['x'], p['far'][0], p['oob'][0], [p['mu'][0]]])
+    ys = np.concatenate([p['y'], p['far'][1], p['oob'][1], [p['mu'][1]]])
+    x_min, x_max = xs.min(), xs.max()
+    y_min, y_max = ys.min(), ys.max()
+    pad_x = max(x_max - x_min, 0.2)*0.05
+    pad_y = max(y_max - y_min, 0.2)*0.05
+    x_min, x_max = x_min - pad_x, x_max + pad_x
+    y_min, y_max = y_min - pad_y, y_max + pad_y
+
+    left, right, top, bottom = MARGIN
+    w = WIDTH - left - right
+    h = HEIGHT - top - bottom
+
+    def px(x):
+        return left + (np.asarray(x) - x_min)/(x_max - x_min)*w
+
+    def py(y):
+        return top + (y_max - np.asarray(y))/(y_max - y_min)*h
+
+    def dots(x, y):
+        # zero-length round-capped strokes: one path element for all points
+        return ''.join('M%.1f %.1fh0' % (a, b) for a, b in zip(px(x), py(y)))
+
+    def marks(x, y, cross, r=4):
+        if cross:
+            seg = 'M%.1f %.1fl{0} {0}m0 -{0}l-{0} {0}'.format(2*r)
+            return ''.join(seg % (a - r, b - r) for a, b in zip(px(x), py(y)))
+        seg = 'M%.1f %.1fh{0}M%.1f %.1fv{0}'.format(2*r)
+        return ''.join(seg % (a - r, b, a, b - r) for a, b in zip(px(x), py(y)))
+
+    out = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d">'
+           % (WIDTH, HEIGHT),
+           '<rect x="%d" y="%d" width="%d" height="%d" fill="#eaeaf2"/>'
+           % (left, top, w, h)]
+
+    # highlight the regions exceeding thresholds
+    lim = p['limits']
+    if lim['price_min'] > x_min:
+        out.append('<rect x="%d" y="%d" width="%.1f" height="%d" fill="red" '
+                   'fill-opacity="0.1"/>'
+                   % (left, top, px(min(lim['price_min'], x_max)) - left, h))
+    if lim['price_max'] < x_max:
+        x0 = px(max(lim['price_max'], x_min))
+        out.append('<rect x="%.1f" y="%d" width="%.1f" height="%d" fill="red" '
+                   'fill-opacity="0.1"/>' % (x0, top, left + w - x0, h))
+    if lim['weight'] < y_max:
+        y0 = py(max(lim['weight'], y_min))
+        out.append('<rect x="%d" y="%d" width="%d" height="%.1f" fill="blue" '
+                   'fill-opacity="0.1"/>' % (left, top, w, y0 - top))
+
+    # axes ticks, in the same shifted log scale as the data
+    for t in _ticks(x_min, x_max):
+        out.append('<text x="%.1f" y="%d" font-size="10" text-anchor="middle">'
+                   '%g</text>' % (px(t), top + h + 12, round(t, 6)))
+    for t in _ticks(y_min, y_max):
+        out.append('<text x="%d" y="%.1f" font-size="10" text-anchor="end">'
+                   '%g</text>' % (left - 4, py(t) + 3, round(t, 6)))
+    out.append('<text x="%.1f" y="%d" font-size="11" text-anchor="middle">'
+               'unit_price</text>' % (left + w/2, HEIGHT - 8))
+    out.append('<text x="10" y="%.1f" font-size="11" text-anchor="middle" '
+               'transform="rotate(-90 10 %.1f)">%s</text>'
+               % (top + h/2, top + h/2, html.escape(p['ycol'])))
+
+    out.append('<path d="%s" stroke="#4c72b0" stroke-width="5" '
+               'stroke-linecap="round" stroke-opacity="0.7"/>'
+               % dots(p['x'], p['y']))
+    if p['far'][0].size > 0:
+        out.append('<path d="%s" stroke="magenta" stroke-width="2"/>'
+                   % marks(*p['far'], cross=False))
+    if p['oob'][0].size > 0:
+        out.append('<path d="%s" stroke="green" stroke-width="2"/>'
+                   % marks(*p['oob'], cross=True))
+
+    # centroid star
+    cx, cy = px(p['mu'][0]), py(p['mu'][1])
+    angles = np.pi/2 + np.arange(10)*np.pi/5
+    radii = np.where(np.arange(10) % 2 == 0, 9, 3.6)
+    star = ' '.join('%.1f,%.1f' % (cx + r*np.cos(a), cy - r*np.sin(a))
+                    for r, a in zip(radii, angles))
+    out.append('<polygon points="%s" fill="red"/>' % star)
+    out.append('</svg>')
+    return ''.join(out)
+
+def write(panels, date, compress=False, profiler=profiling.NULL):
+    """
+    Write one self-contained html report with a plot for every flagged species,
+    to replace a png attachment per species.
+
+    Parameters
+    ----------
+    panels (list[dict])
+        from panel
+    date (str)
+        e.g. '2021-03-12'
+    compress (bool)
+        gzip the report (report.html.gz)
+    profiler (profiling.Profiler)
+        gets the time spent drawing each species' plot, as its plotting time
+
+    Returns:
+    path (Path)
+        where the report was written
+    """
+    body = []
+    for p in panels:
+        with profiler.section_of(p['country'], p['buying_unit'], 'plotting'):
+            figure = svg(p)
+        body.append('<figure><figcaption>%s<br>%s</figcaption>%s</figure>'
+                    % (html.escape(p['title']), html.escape(p['subtitle']), figure))
+    doc = ('<!DOCTYPE html><html><head><meta charset="utf-8">'
+           '<title>Potential outliers %s</title><style>'
+           'body{font-family:sans-serif}figure{display:inline-block;margin:8px}'
+           'figcaption{text-align:center;font-size:13px}</style></head><body>'
+           '<h2>Potential outliers %s</h2><p>Plots are in a shifted log scale: '
+           '-1 on the graph means the value is actually 0. '
+           '<span style="color:red">&#9733;</span> centroid, '
+           '<span style="color:magenta">+</span> far from the other samples, '
+           '<span style="color:green">&#215;</span> past a threshold.</p>%s'
+           '</body></html>') % (date, date, ''.join(body))
+
+    path = Path('./plots/'+date.replace('-', '_')+'/report.html')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if compress:
+        path = path.with_suffix('.html.gz')
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            f.write(doc)
+    else:
+        path.write_text(doc, encoding='utf-8')
+    return path
@@ -0,0 +1,145 @@
+"""
+Ask "would these transactions be flagged?" without running the whole pipeline.
+
+Score a csv of candidate records against the saved models:
+
+    python score.py rows.csv [--models data/models.npz]
+
+Refit the models from the archive first (data/clean_catch_data.csv):
+
+    python score.py --fit
+
+Or serve them over http; POST a json list of records to /score:
+
+    python score.py --serve 8081
+
+The server picks up new models when the file changes, e.g. after the daemon's
+nightly refit.
+
+Records need country, buying_unit, unit_price, weight_kg and weight_lbs.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import archive
+import models
+
+def score_records(m, records):
+    """
+    Score a list of records (dicts) against models.
+
+    Returns:
+    results (list[dict])
+        one per record, in order: {'flagged': bool, 'distance': float or None,
+        'far': bool, 'oob': bool}, plus the record's id if it had one
+    """
+    if len(records) == 0: # no columns to score
+        return []
+    rows = pd.DataFrame.from_records(records)
+    scores = models.score(m, rows)
+    scores['distance'] = scores['distance'].astype(object)\
+                            .where(scores['distance'].notna(), None)
+    if 'id' in rows.columns:
+        scores.insert(0, 'id', rows['id'].values)
+    return scores.to_dict(orient='records')
+
+def reloader(path):
+    """
+    Returns:
+    get (function)
+        returns the models saved at path, reloading them whenever the file
+        changes; if the new file can't be read, the old models are kept
+    """
+    cache = {'version': None, 'models': None}
+    lock = threading.Lock()
+
+    def get():
+        with lock:
+            try:
+                st = os.stat(path)
+                # models.save replaces the file, so it gets a new inode too
+                version = (st.st_mtime_ns, st.st_ino)
+                if version != cache['version']:
+                    cache['models'] = models.load(path)
+                    cache['version'] = version
+            except (OSError, ValueError, KeyError):
+                if cache['models'] is None:
+                    raise
+            return cache['models']
+
+    return get
+
+def make_handler(get_models):
+    """
+    Helper function. Request handler class that scores against the models
+    returned by get_models (see reloader)
+    """
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/score':
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                if length < 0: # rfile.read would wait for the client to hang up
+                    raise ValueError("negative Content-Length")
+                records = json.loads(self.rfile.read(length))
+                if isinstance(records, dict): # a single record
+                    records = [records]
+                results = score_records(get_models(), records)
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_error(400, str(e))
+                return
+            body = json.dumps(results, default=_to_builtin).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+def _to_builtin(x):
+    if isinstance(x, np.generic):
+        return x.item()
+    raise TypeError(type(x))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('rows', nargs='?', help='csv of records to score')
+    parser.add_argument('--models', default=str(models.MODELS_PATH),
+                        help='saved models (default: %(default)s)')
+    parser.add_argument('--fit', action='store_true',
+                        help='refit the models from the archive and save them')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='serve the models over http on this port')
+    args = parser.parse_args(argv)
+
+    if args.fit:
+        archive_df = pd.read_csv(str(archive.ARCHIVE_DF_PATH))
+        fish = pd.read_csv(str(archive.FISH_PATH))
+        models.save(models.fit(archive_df, fish), args.models)
+
+    if args.serve is not None:
+        get_models = reloader(args.models)
+        get_models() # fail now if there are no models
+        server = ThreadingHTTPServer(('127.0.0.1', args.serve),
+                                     make_handler(get_models))
+        server.serve_forever()
+    elif args.rows is not None:
+        m = models.load(args.models)
+        rows = pd.read_csv(args.rows)
+        scores = models.score(m, rows)
+        if 'id' in rows.columns:
+            scores.insert(0, 'id', rows['id'].values)
+        scores.to_csv(sys.stdout, index=False)
+
+if __name__ == '__main__':
+    main()
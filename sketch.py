@@ -0,0 +1,215 @@
+import json
+import zlib
+import numpy as np
+from pathlib import Path
+import params
+
+SKETCH_PATH = Path('./data/quantile_sketches.json')
+# default rank error of the sketches, as a fraction of the number of samples
+DEFAULT_EPS = 0.005
+# log-scale columns that get a sketch per (country, buying_unit)
+COLUMNS = ['unit_price', 'weight_kg', 'weight_lbs']
+
+class KLL:
+    """
+    Mergeable quantile sketch (Karnin, Lang & Liberty 2016). Keeps a few
+    hundred samples no matter how many are added, and answers quantile queries
+    with a rank error of about eps*n.
+
+    Level h holds samples that each stand for 2**h of the samples added. When
+    the sketch is full, a level is sorted and every other sample is promoted
+    to the level above.
+    """
+
+    def __init__(self, eps=DEFAULT_EPS, seed=None):
+        self.eps = eps
+        # the rank error of KLL with c = 2/3 is about 1.7/k
+        self.k = max(8, int(np.ceil(1.7/eps)))
+        self.c = 2/3
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def capacity(self, h):
+        depth = len(self.levels) - h - 1
+        return max(2, int(np.ceil(self.k*self.c**depth)))
+
+    def size(self):
+        return sum(level.size for level in self.levels)
+
+    def max_size(self):
+        return sum(self.capacity(h) for h in range(len(self.levels)))
+
+    def exact(self):
+        """
+        Whether the sketch still holds every sample added (none were compacted
+        yet), in which case quantiles are better computed from the samples.
+        """
+        return len(self.levels) == 1
+
+    def update(self, x):
+        """
+        Add samples (a number or an array) to the sketch. nan is ignored.
+        """
+        x = np.asarray(x, dtype=float).ravel()
+        x = x[~np.isnan(x)]
+        self.n += x.size
+        self.levels[0] = np.concatenate([self.levels[0], x])
+        self.compress()
+
+    def merge(self, other):
+        """
+        Add all the samples summarized by another sketch to this one.
+        """
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, level in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], level])
+        self.n += other.n
+        self.compress()
+
+    def compress(self):
+        while self.size() >= self.max_size():
+            for h in range(len(self.levels)):
+                level = self.levels[h]
+                if level.size >= self.capacity(h):
+                    if h + 1 == len(self.levels):
+                        self.levels.append(np.empty(0))
+                    level = np.sort(level)
+                    # an odd sample out stays behind
+                    keep = level[level.size - level.size % 2:]
+                    pairs = level[:level.size - level.size % 2]
+                    offset = self.rng.integers(2)
+                    self.levels[h+1] = np.concatenate([self.levels[h+1],
+                                                       pairs[offset::2]])
+                    self.levels[h] = keep
+                    break
+
+    def quantile(self, q):
+        """
+        Approximate q-th quantile(s) of the samples added, like np.quantile
+        with method='inverted_cdf'.
+        """
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(level.size, 2.0**h)
+                                  for h, level in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        items = items[order]
+        cum = np.cumsum(weights[order])
+        pos = np.searchsorted(cum, np.asarray(q)*cum[-1], side='left')
+        return items[np.minimum(pos, items.size - 1)]
+
+    def to_dict(self):
+        return {
+            'eps': self.eps,
+            'n': self.n,
+            'levels': [level.tolist() for level in self.levels],
+            'rng': self.rng.bit_generator.state
+        }
+
+    @classmethod
+    def from_dict(cls, d, seed=None):
+        """
+        Sketch saved with to_dict. Its coin flips carry on where they left
+        off; sketches saved without their rng state start from seed.
+        """
+        s = cls(d['eps'], seed)
+        s.n = d['n']
+        s.levels = [np.array(level, dtype=float) for level in d['levels']]
+        if 'rng' in d:
+            s.rng.bit_generator.state = d['rng']
+        return s
+
+def seed_of(key):
+    """
+    Seed of the sketch of a key such as (country, buying_unit, col), so that
+    the same samples always give the same sketch (hash() of a str changes from
+    one run to the next).
+    """
+    return zlib.crc32('\x1f'.join(key).encode('utf-8'))
+
+def build(archive_df, eps=DEFAULT_EPS, sketches=None):
+    """
+    Add the log-scale samples of archive_df to per-(country, buying_unit, col)
+    sketches, creating any that don't exist yet.
+
+    Parameters
+    ----------
+    archive_df (DataFrame)
+        transaction samples, from data_clean.main
+    eps (float)
+        rank error of new sketches
+    sketches (dict or None)
+        existing sketches to update; a new dict is made if None
+
+    Returns:
+    sketches (dict)
+        {(country, buying_unit, col): KLL}
+    """
+    if sketches is None:
+        sketches = {}
+    archive_df = archive_df.dropna(subset=['buying_unit'])
+    for (country, fname), f_df in archive_df.groupby(['country', 'buying_unit']):
+        for col in COLUMNS:
+            key = (country, fname, col)
+            if key not in sketches:
+                sketches[key] = KLL(eps, seed_of(key))
+            sketches[key].update(np.log10(f_df[col].values +
+                                          params.current['log_offset']))
+    return sketches
+
+def by_species(sketches):
+    """
+    Merge the sketches of every country into one per (buying_unit, col), for
+    when a species is judged on its samples from all countries together.
+    """
+    merged = {}
+    # in a fixed order, as the result of a merge depends on it
+    for (country, fname, col), s in sorted(sketches.items()):
+        key = (fname, col)
+        if key not in merged:
+            merged[key] = KLL(s.eps, seed_of(key))
+        merged[key].merge(s)
+    return merged
+
+def save(sketches, rows, path=SKETCH_PATH):
+    """
+    Write sketches to a json file, along with the number of archive rows they
+    summarize and the log offset of the samples, so that load can tell if they
+    are out of date.
+    """
+    out = {
+        'rows': int(rows),
+        'log_offset': params.current['log_offset'],
+        'sketches': [[country, fname, col, s.to_dict()]
+                     for (country, fname, col), s in sketches.items()]
+    }
+    with open(path, 'w') as f:
+        json.dump(out, f)
+
+def load(archive_df, eps=DEFAULT_EPS, path=SKETCH_PATH):
+    """
+    Load the sketches saved with the archive. They are rebuilt from archive_df
+    (and saved) if they are missing, don't cover every archive row, or were
+    made with a different eps or log offset.
+
+    Returns:
+    sketches (dict)
+        {(country, buying_unit, col): KLL}
+    """
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+        sketches = {}
+        for country, fname, col, d in saved['sketches']:
+            key = (country, fname, col)
+            sketches[key] = KLL.from_dict(d, seed_of(key))
+        if saved['rows'] == archive_df.shape[0] and \
+                saved.get('log_offset') == params.current['log_offset'] and \
+                all(s.eps == eps for s in sketches.values()):
+            return sketches
+    except FileNotFoundError:
+        pass
+    sketches = build(archive_df, eps)
+    save(sketches, archive_df.shape[0], path)
+    return sketches
@@ -0,0 +1,214 @@
+import json
+import select
+import time
+import traceback
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import data_clean
+import health
+import models
+import postgres
+
+WATERMARK_PATH = Path('./data/stream_watermark.json')
+
+def load_watermark(archive_df=None):
+    """
+    Get the high-water mark (largest fishdata_catch.id and its date) of the
+    records that have already been scored. If nothing has been streamed yet,
+    start from the newest record in the archive.
+
+    Returns:
+    watermark (dict)
+        {'id': int, 'date': str or None}
+    """
+    try:
+        with open(WATERMARK_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        if archive_df is None or archive_df.shape[0] == 0:
+            return {'id': 0, 'date': None}
+        last = archive_df.loc[archive_df['id'].idxmax()]
+        return {'id': int(last['id']), 'date': str(last['date'])}
+
+def save_watermark(watermark):
+    with open(WATERMARK_PATH, 'w') as f:
+        json.dump(watermark, f)
+
+def fetch_new(conn, watermark, batch_size=500):
+    """
+    Fetch the next micro-batch of raw catch records past the watermark.
+    `conn` can be any DB-API connection using the %s paramstyle (psycopg2 or a
+    local stand-in), as long as it has a fishdata_catch table.
+
+    Returns:
+    pg_data (DataFrame)
+        raw records, same columns as postgres.query_data
+    """
+    sql = """SELECT * FROM fishdata_catch
+    WHERE id > %s ORDER BY id LIMIT %s"""
+    cur = conn.cursor()
+    cur.execute(sql, (watermark['id'], batch_size))
+    cols = [d[0] for d in cur.description]
+    pg_data = pd.DataFrame(cur.fetchall(), columns=cols)
+    cur.close()
+    conn.rollback() # don't leave an idle transaction open between polls
+
+    if pg_data.shape[0] > 0:
+        # psycopg2 turns json columns into dicts, but unravel wants the text
+        pg_data['data'] = pg_data['data'].apply(
+            lambda x: x if isinstance(x, str) else json.dumps(x))
+    return pg_data
+
+def listen(conn, channel):
+    """
+    Subscribe `conn` to a pg notification channel, so wait_for_rows can wake up
+    as soon as new records come in instead of on a fixed poll interval. The
+    server needs a trigger that notifies the channel, e.g.
+
+    CREATE FUNCTION notify_catch() RETURNS trigger AS $$
+    BEGIN PERFORM pg_notify('new_catch', NEW.id::text); RETURN NEW; END;
+    $$ LANGUAGE plpgsql;
+    CREATE TRIGGER catch_inserted AFTER INSERT ON fishdata_catch
+    FOR EACH ROW EXECUTE PROCEDURE notify_catch();
+    """
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("LISTEN " + channel)
+    cur.close()
+
+def wait_for_rows(conn, timeout, listening=False):
+    """
+    Block until there may be new records: until a notification arrives on a
+    listening connection (or the timeout passes), or for `timeout` seconds.
+    """
+    if not listening:
+        time.sleep(timeout)
+        return
+    if select.select([conn], [], [], timeout) != ([], [], []):
+        conn.poll()
+        conn.notifies.clear()
+
+def score_batch(pg_data, state):
+    """
+    Clean a micro-batch of raw records and score them against the cached
+    per-species models in state['models'].
+
+    Returns:
+    data (DataFrame)
+        cleaned records (postgres.clean_postgres_data)
+    scores (DataFrame)
+        models.score output for the records that survived data_clean.main,
+        with their ids
+    """
+    data = postgres.clean_postgres_data(pg_data)
+    if data.shape[0] == 0:
+        return data, pd.DataFrame(columns=['id', 'distance', 'far', 'oob', 'flagged'])
+    df = data_clean.main(data)
+    scores = models.score(state['models'], df)
+    scores.insert(0, 'id', df['id'].values)
+    return data, scores
+
+def write_flagged(flagged_data):
+    """
+    Default handler for flagged records: append them to the day's stream csv.
+    """
+    day = str(np.datetime64('today'))
+    path = Path('./flagged_data/' + day + '_stream.csv')
+    flagged_data.to_csv(str(path), mode='a', header=not path.exists(), index=False)
+
+def _failed(what, e):
+    """
+    Helper function for run. Log the traceback of the exception e being
+    handled to the day's stream log and report it to the health endpoint.
+    """
+    day = str(np.datetime64('today'))
+    Path('./logs').mkdir(exist_ok=True)
+    with open('./logs/' + day + '_stream.log', 'a') as logf:
+        logf.write('%s: %s failed\n' % (np.datetime64('now'), what))
+        traceback.print_exc(file=logf)
+    health.stream_error('%s failed: %r' % (what, e))
+
+def _pause(seconds, stop):
+    if stop is None:
+        time.sleep(seconds)
+    else:
+        stop.wait(seconds)
+
+def run(conn, state, on_flagged=write_flagged, batch_size=500, poll_seconds=60,
+        channel=None, stop=None, pool=None):
+    """
+    Score new catch records as they arrive. Records are fetched in micro-batches
+    past a persisted high-water mark on fishdata_catch.id, either every
+    `poll_seconds` or, if `channel` is given, as soon as the server notifies
+    it (see listen). Each batch is scored against the models cached in
+    state['models'], which the nightly run refits.
+
+    Errors don't stop the stream; they are logged to ./logs/ and reported on
+    the health endpoint. If fetching fails, the connection is handed back to
+    `pool` (if given) and a new one is taken before trying again after
+    poll_seconds. A batch that can't be scored (e.g. a malformed data payload)
+    is skipped; its records are still checked by the nightly run.
+
+    Parameters
+    ----------
+    conn (connection or None)
+        DB-API connection to the pg server (or a stand-in when polling); taken
+        from pool if None
+    state (dict)
+        warm archive from archive.load, with 'models' from models.fit
+    on_flagged (function)
+        called with the full records of every flagged sample in a batch
+    batch_size (int)
+        most records fetched per micro-batch
+    poll_seconds (float)
+        time between polls, or longest wait between notifications
+    channel (str or None)
+        pg notification channel to LISTEN on
+    stop (threading.Event or None)
+        set it to make run return after the current batch
+    pool (connection pool or None)
+        where to get a new connection after a failure
+    """
+    watermark = load_watermark(state['archive_df'])
+    listening = False
+    health.stream_started()
+
+    while stop is None or not stop.is_set():
+        try:
+            if conn is None:
+                conn = pool.getconn()
+            if channel is not None and not listening:
+                listen(conn, channel)
+                listening = True
+            pg_data = fetch_new(conn, watermark, batch_size)
+        except Exception as e:
+            _failed('fetching new records', e)
+            if pool is not None and conn is not None:
+                try: # don't hand a dead connection back to the pool
+                    pool.putconn(conn, close=True)
+                except Exception:
+                    pass
+                conn = None
+                listening = False
+            _pause(poll_seconds, stop)
+            continue
+
+        if pg_data.shape[0] == 0:
+            wait_for_rows(conn, poll_seconds, listening=listening)
+            continue
+
+        last = pg_data.loc[pg_data['id'].idxmax()]
+        try:
+            data, scores = score_batch(pg_data, state)
+            flag_ids = scores.loc[scores['flagged'], 'id']
+            if flag_ids.size > 0:
+                on_flagged(data[data['id'].isin(flag_ids)])
+        except Exception as e:
+            _failed('scoring records %d to %d'
+                    % (pg_data['id'].min(), last['id']), e)
+        else:
+            health.stream_batch(pg_data.shape[0], flag_ids.size)
+
+        watermark = {'id': int(last['id']), 'date': str(last['date'])}
+        save_watermark(watermark)